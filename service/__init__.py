@@ -8,7 +8,7 @@ import sys
 from flask import Flask
 from flask_restx import Api
 from service import config
-from service.common import log_handlers
+from service.common import compression, log_handlers
 
 # Create Flask application
 app = Flask(__name__)
@@ -35,10 +35,13 @@ api = Api(
 # pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
 from service import routes, models  # noqa: E402, E261
 # pylint: disable=wrong-import-position
-from service.common import error_handlers, cli_commands  # noqa: F401, E402
+from service.common import (  # noqa: F401, E402
+    error_handlers, cli_commands, group_commit, session_hooks, warmup
+)
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
+compression.init_compression(app)
 
 app.logger.info(70 * "*")
 app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
@@ -51,4 +54,23 @@ except Exception as error:  # pylint: disable=broad-except
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
+engine_options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+app.logger.info(
+    "Database pool: size=%s max_overflow=%s timeout=%ss recycle=%ss pre_ping=%s",
+    engine_options["pool_size"],
+    engine_options["max_overflow"],
+    engine_options["pool_timeout"],
+    engine_options["pool_recycle"],
+    engine_options["pool_pre_ping"],
+)
+app.logger.info(
+    "Database session: %s expire_on_commit=%s",
+    engine_options["connect_args"]["options"],
+    app.config["SQLALCHEMY_EXPIRE_ON_COMMIT"],
+)
+group_commit.init_group_commit(app)
+# The worker only serves requests, the readiness probe included, once this returns
+if app.config["WARMUP_ENABLED"]:
+    app.extensions["warmup"] = warmup.warm_up(app)
+
 app.logger.info("Service initialized!")
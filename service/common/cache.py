@@ -0,0 +1,375 @@
+"""
+Cache Backends
+
+This module contains the caches that sit in front of the database for
+reads of serialized objects. Every backend has the same get/set/delete
+interface so they can be swapped with the CACHE_BACKEND setting.
+
+The shared backends (redis, and sqlite as a stand-in on a single host)
+are seen by every worker. Their keys are stamped with a version that
+delete() bumps, so an invalidation from any worker hides the old value
+from all of them, and a value read from the database before the bump
+is written under a version nobody reads any more.
+"""
+import json
+import time
+import sqlite3
+import threading
+from abc import abstractmethod
+from collections import OrderedDict
+from service.common.serializer import dumps
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+class BaseCache:
+    """A base class for caches that counts hits and misses"""
+
+    name = None
+    # Whether every worker sees the same values, and the same deletes
+    shared = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def get(self, key):
+        """ Returns the cached value of a key, or None on a miss """
+
+    def lookup(self, key):
+        """
+        Returns the cached value of a key and a stamp to pass to set()
+
+        The stamp lets a shared cache drop the value set after a miss if
+        the key was invalidated in between.
+        """
+        return self.get(key), None
+
+    @abstractmethod
+    def set(self, key, value, stamp=None):
+        """ Caches a value under a key """
+
+    @abstractmethod
+    def delete(self, key):
+        """ Drops the cached value of a key """
+
+    def delete_many(self, keys):
+        """ Drops the cached values of many keys """
+        for key in keys:
+            self.delete(key)
+
+    @abstractmethod
+    def clear(self):
+        """ Drops every cached value """
+
+    def size(self) -> int:
+        """ Returns the number of cached values """
+        return 0
+
+    def stats(self) -> dict:
+        """ Returns the counters of the cache """
+        return {"backend": self.name, "hits": self.hits, "misses": self.misses, "size": self.size()}
+
+
+class NullCache(BaseCache):
+    """A cache that stores nothing, every lookup is a miss"""
+
+    name = "null"
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value, stamp=None):
+        """ Nothing is stored """
+
+    def delete(self, key):
+        """ Nothing is stored """
+
+    def clear(self):
+        """ Nothing is stored """
+
+
+class LRUCache(BaseCache):
+    """
+    An in-process least recently used cache with a TTL and a size bound
+
+    Every delete moves a counter that lookup() hands out as the stamp, so
+    a value read from the database before a delete is not set after it.
+    """
+
+    name = "memory"
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._deletes = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        stamp = self._deletes
+        return self.get(key), stamp
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, stamp=None):
+        with self._lock:
+            if stamp is not None and stamp != self._deletes:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._deletes += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._deletes += 1
+            self._entries.clear()
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "maxsize": self.maxsize, "ttl": self.ttl}
+
+
+class SharedCache(BaseCache):
+    """
+    A cache kept outside of the worker, with version stamped keys
+
+    A value is stored under {prefix}:{generation}:{key}:{version}. delete()
+    bumps the version of the key and clear() bumps the generation, so
+    neither has to find the stored values, which simply expire. The
+    versions and the generation expire too, long after the values stamped
+    with them, so every key the cache writes is bounded by a TTL.
+    """
+
+    # Versions outlive the values stamped with them so a version is never reused
+    VERSION_TTL_FACTOR = 10
+    shared = True
+
+    def __init__(self, ttl: float = 60.0, prefix: str = "orders"):
+        super().__init__()
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @abstractmethod
+    def _get_many(self, keys) -> list:
+        """ Returns the raw values of keys, None for the missing ones """
+
+    @abstractmethod
+    def _put(self, key: str, raw: bytes, ttl: float):
+        """ Stores a raw value for ttl seconds """
+
+    @abstractmethod
+    def _incr(self, key: str, ttl=None) -> int:
+        """ Atomically increments a counter, which expires ttl seconds later """
+
+    @abstractmethod
+    def _incr_many(self, keys, ttl=None):
+        """ Atomically increments many counters in one round trip """
+
+    def _version_key(self, key) -> str:
+        return f"{self.prefix}:version:{key}"
+
+    def _value_key(self, key, stamp) -> str:
+        return f"{self.prefix}:{stamp}:{key}"
+
+    def lookup(self, key):
+        generation, version = self._get_many([f"{self.prefix}:generation", self._version_key(key)])
+        stamp = f"{int(generation or 0)}:{int(version or 0)}"
+        raw = self._get_many([self._value_key(key, stamp)])[0]
+        if raw is None:
+            self.misses += 1
+            return None, stamp
+        self.hits += 1
+        return json.loads(raw), stamp
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def set(self, key, value, stamp=None):
+        if stamp is None:
+            stamp = self.lookup(key)[1]
+        self._put(self._value_key(key, stamp), dumps(value), self.ttl)
+
+    def delete(self, key):
+        self._incr(self._version_key(key), self.ttl * self.VERSION_TTL_FACTOR)
+
+    def delete_many(self, keys):
+        keys = [self._version_key(key) for key in keys]
+        if keys:
+            self._incr_many(keys, self.ttl * self.VERSION_TTL_FACTOR)
+
+    def clear(self):
+        self._incr(f"{self.prefix}:generation", self.ttl * self.VERSION_TTL_FACTOR)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "ttl": self.ttl}
+
+
+class SQLiteCache(SharedCache):
+    """
+    A shared cache in a SQLite file, for the workers of a single host
+
+    It stands in for the redis backend where there is no redis server,
+    such as in the tests. Each thread opens its own connection. SQLite
+    does not expire rows by itself, so a write purges the expired rows
+    once every TTL.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, ttl: float = 60.0, prefix: str = "orders"):
+        super().__init__(ttl, prefix)
+        self.path = path
+        self._purged = time.time()
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)"
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _get_many(self, keys) -> list:
+        rows = dict(self._connection().execute(
+            f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(keys))})"
+            " AND (expires IS NULL OR expires > ?)",
+            [*keys, time.time()],
+        ).fetchall())
+        return [rows.get(key) for key in keys]
+
+    def _put(self, key: str, raw: bytes, ttl: float):
+        now = time.time()
+        if now - self._purged >= self.ttl:
+            self._purged = now
+            self._purge(now)
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, raw, now + ttl),
+        )
+
+    def _purge(self, now: float):
+        """ Deletes the rows that have expired """
+        self._connection().execute("DELETE FROM cache WHERE expires <= ?", (now,))
+
+    def _incr(self, key: str, ttl=None) -> int:
+        expires = None if ttl is None else time.time() + ttl
+        return self._connection().execute(
+            "INSERT INTO cache (key, value, expires) VALUES (?, 1, ?)"
+            " ON CONFLICT (key) DO UPDATE SET value = value + 1, expires = excluded.expires"
+            " RETURNING value",
+            (key, expires),
+        ).fetchone()[0]
+
+    def _incr_many(self, keys, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT INTO cache (key, value, expires) VALUES (?, 1, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = value + 1, expires = excluded.expires",
+                [(key, expires) for key in keys],
+            )
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def clear(self):
+        super().clear()
+        self._purge(time.time())
+
+    def size(self) -> int:
+        return self._connection().execute(
+            "SELECT count(*) FROM cache WHERE expires > ? AND key NOT LIKE ?",
+            (time.time(), f"{self.prefix}:version:%"),
+        ).fetchone()[0]
+
+
+class RedisCache(SharedCache):
+    """A shared cache in redis, for the workers of every pod, needs the redis package"""
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl: float = 60.0, prefix: str = "orders"):
+        super().__init__(ttl, prefix)
+        self.client = redis.Redis.from_url(url)
+
+    def _get_many(self, keys) -> list:
+        return self.client.mget(keys)
+
+    def _put(self, key: str, raw: bytes, ttl: float):
+        self.client.set(key, raw, px=int(ttl * 1000))
+
+    def _incr(self, key: str, ttl=None) -> int:
+        with self.client.pipeline() as pipeline:
+            pipeline.incr(key)
+            if ttl is not None:
+                pipeline.pexpire(key, int(ttl * 1000))
+            return pipeline.execute()[0]
+
+    def _incr_many(self, keys, ttl=None):
+        with self.client.pipeline() as pipeline:
+            for key in keys:
+                pipeline.incr(key)
+                if ttl is not None:
+                    pipeline.pexpire(key, int(ttl * 1000))
+            pipeline.execute()
+
+    def size(self):
+        """ Values of other workers are not counted, so the size is unknown """
+        return None
+
+
+def make_cache(config, ttl=None, maxsize=None, prefix=None):
+    """
+    Creates the cache backend named by CACHE_BACKEND
+
+    The TTL, size and key prefix of the config can be overridden to make
+    a second cache on the same backend.
+    """
+    backend = config.get("CACHE_BACKEND", "null")
+    ttl = config.get("CACHE_TTL", 60.0) if ttl is None else ttl
+    maxsize = config.get("CACHE_MAXSIZE", 1024) if maxsize is None else maxsize
+    prefix = ":".join(filter(None, (config.get("CACHE_PREFIX", "orders"), prefix)))
+    if backend == LRUCache.name:
+        return LRUCache(maxsize, ttl)
+    if backend == NullCache.name:
+        return NullCache()
+    if backend == SQLiteCache.name:
+        return SQLiteCache(config["CACHE_URL"], ttl, prefix)
+    if backend == RedisCache.name:
+        if redis is None:
+            raise ValueError("The redis cache backend needs the redis package")
+        return RedisCache(config["CACHE_URL"], ttl, prefix)
+    raise ValueError(f"Unknown cache backend: {backend}")
@@ -1,8 +1,17 @@
 """
 Flask CLI Command Extensions
+
+The maintenance commands scan or rewrite whole tables, so they lift the
+statement timeout of the app, DB_STATEMENT_TIMEOUT, while they run.
 """
+import click
+from sqlalchemy import MetaData, text
+from sqlalchemy.schema import CreateColumn
 from service import app
-from service.models import db
+from service.models import db, CustomerSummary, IdempotencyKey, Order
+
+# Lifts the statement timeout until the end of the transaction
+NO_TIMEOUT = text("SET LOCAL statement_timeout = 0")
 
 
 ######################################################################
@@ -19,3 +28,107 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to create any missing indexes
+# Usage:
+#   flask db-indexes
+######################################################################
+@app.cli.command("db-indexes")
+def db_indexes():
+    """
+    Creates the indexes declared on the models that are missing from
+    the database. Existing tables and data are left untouched, and each
+    index is built CONCURRENTLY, outside of a transaction, so the table
+    is not locked against writes meanwhile. A build that fails leaves an
+    INVALID index behind, drop it before running this again.
+    """
+    for table in db.metadata.sorted_tables:
+        # a copy, create_all() builds the indexes of the models in a transaction
+        copy = table.to_metadata(MetaData())
+        for index in sorted(copy.indexes, key=lambda index: index.name):
+            index.dialect_kwargs["postgresql_concurrently"] = True
+            with db.engine.connect() as connection:
+                connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(text("SET statement_timeout = 0"))
+                try:
+                    index.create(bind=connection, checkfirst=True)
+                finally:
+                    connection.execute(text("RESET statement_timeout"))
+            click.echo(f"Index {index.name} on {table.name} is in place")
+
+
+######################################################################
+# Command to recompute the customer order summaries
+# Usage:
+#   flask db-summaries
+######################################################################
+@app.cli.command("db-summaries")
+def db_summaries():
+    """
+    Recomputes the order summary of every customer from the orders.
+    Run it once after the summary table is created.
+    """
+    db.session.execute(NO_TIMEOUT)
+    CustomerSummary.rebuild()
+    click.echo("Customer summaries rebuilt")
+
+
+######################################################################
+# Command to add and recompute the item counters of the orders
+# Usage:
+#   flask db-item-counters
+######################################################################
+@app.cli.command("db-item-counters")
+def db_item_counters():
+    """
+    Adds the item_count and items_total columns to the order table when
+    they are missing, then recomputes them from the items in bulk.
+    """
+    table = Order.__table__
+    add_columns(table, table.c.item_count, table.c.items_total)
+    db.session.execute(NO_TIMEOUT)
+    rows = Order.rebuild_item_counters()
+    click.echo(f"Item counters of {rows} orders rebuilt")
+
+
+######################################################################
+# Command to add the version column of the orders
+# Usage:
+#   flask db-order-version
+######################################################################
+@app.cli.command("db-order-version")
+def db_order_version():
+    """
+    Adds the version column of the order table when it is missing. The
+    existing orders start at version 1.
+    """
+    add_columns(Order.__table__, Order.__table__.c.version)
+    click.echo("Order versions are in place")
+
+
+def add_columns(table, *columns):
+    """Adds the columns of a model that are missing from its table"""
+    name = db.engine.dialect.identifier_preparer.format_table(table)
+    db.session.execute(NO_TIMEOUT)
+    for column in columns:
+        definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+        db.session.execute(text(f"ALTER TABLE {name} ADD COLUMN IF NOT EXISTS {definition}"))
+    db.session.commit()
+
+
+######################################################################
+# Command to delete the expired idempotency keys
+# Usage:
+#   flask db-idempotency-purge
+######################################################################
+@app.cli.command("db-idempotency-purge")
+def db_idempotency_purge():
+    """
+    Deletes the idempotency keys older than IDEMPOTENCY_TTL. Expired keys
+    are never answered from, this only keeps the table small.
+    """
+    db.session.execute(NO_TIMEOUT)
+    rows = IdempotencyKey.purge()
+    click.echo(f"{rows} expired idempotency keys deleted")
@@ -0,0 +1,202 @@
+"""
+Response Compression
+
+This module contains an after_request hook that compresses JSON and
+NDJSON responses with the best encoding both the client (Accept-Encoding)
+and this worker support. gzip is always available, brotli and zstd are
+used when their packages are installed. Buffered responses smaller than
+COMPRESS_MIN_SIZE are sent as they are, streamed responses are
+compressed chunk by chunk and flushed so every line still arrives as
+soon as it is produced.
+"""
+import zlib
+import threading
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class GzipEncoder:
+    """Compresses a body as gzip"""
+
+    name = "gzip"
+
+    def __init__(self, level: int):
+        self.level = max(1, min(level, 9))
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a whole body"""
+        encoder = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return encoder.compress(data) + encoder.flush()
+
+    def stream(self, chunks):
+        """Compresses chunks, flushing after each one so it can be sent right away"""
+        encoder = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        yield encoder.flush()
+
+
+class BrotliEncoder:
+    """Compresses a body as brotli, needs the brotli package"""
+
+    name = "br"
+
+    def __init__(self, level: int):
+        self.level = max(0, min(level, 11))
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a whole body"""
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self, chunks):
+        """Compresses chunks, flushing after each one so it can be sent right away"""
+        encoder = brotli.Compressor(quality=self.level)
+        for chunk in chunks:
+            yield encoder.process(chunk) + encoder.flush()
+        yield encoder.finish()
+
+
+class ZstdEncoder:
+    """Compresses a body as zstd, needs the zstandard package"""
+
+    name = "zstd"
+
+    def __init__(self, level: int):
+        self.level = max(1, min(level, 22))
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a whole body"""
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self, chunks):
+        """Compresses chunks, flushing after each one so it can be sent right away"""
+        encoder = zstandard.ZstdCompressor(level=self.level).compressobj()
+        for chunk in chunks:
+            yield encoder.compress(chunk) + encoder.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        yield encoder.flush()
+
+
+ENCODERS = {GzipEncoder.name: GzipEncoder}
+if brotli is not None:
+    ENCODERS[BrotliEncoder.name] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS[ZstdEncoder.name] = ZstdEncoder
+
+
+class Compressor:
+    """Negotiates and applies the compression of responses, and counts the bytes saved"""
+
+    def __init__(self, algorithms, level: int = 6, min_size: int = 1024, mimetypes=()):
+        self.encoders = [ENCODERS[name](level) for name in algorithms if name in ENCODERS]
+        self.min_size = min_size
+        self.mimetypes = set(mimetypes)
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def negotiate(self, accept_encodings):
+        """Returns the encoder the client prefers, ties going to the order of algorithms"""
+        best = accept_encodings.best_match([encoder.name for encoder in self.encoders])
+        return next((encoder for encoder in self.encoders if encoder.name == best), None)
+
+    def count(self, name: str, size: int, compressed: int):
+        """Adds a response to the byte counters of an encoding"""
+        with self._lock:
+            counter = self._counters.setdefault(name, {"responses": 0, "bytes_in": 0, "bytes_out": 0})
+            counter["responses"] += 1
+            counter["bytes_in"] += size
+            counter["bytes_out"] += compressed
+
+    def stats(self) -> dict:
+        """Returns the byte counters and compression ratio of every encoding"""
+        with self._lock:
+            stats = {"algorithms": [encoder.name for encoder in self.encoders], "min_size": self.min_size}
+            for name, counter in self._counters.items():
+                ratio = counter["bytes_in"] / counter["bytes_out"] if counter["bytes_out"] else None
+                stats[name] = {**counter, "ratio": ratio}
+            return stats
+
+    def __call__(self, response):
+        """Compresses a response when it is worth it, as an after_request hook"""
+        if response.mimetype not in self.mimetypes or response.status_code < 200:
+            return response
+        response.vary.add("Accept-Encoding")
+        if (
+            response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough
+        ):
+            return response
+        encoder = self.negotiate(request.accept_encodings)
+        if encoder is None:
+            return response
+        if response.is_streamed:
+            response.response = self._stream(encoder, response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressed = encoder.compress(data)
+            self.count(encoder.name, len(data), len(compressed))
+            response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoder.name
+        # The compressed bytes differ from the ones the ETag was computed over
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def _stream(self, encoder, chunks):
+        """Compresses a streamed body, counting its bytes once it is complete"""
+        size = compressed = 0
+
+        def source():
+            nonlocal size
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                size += len(chunk)
+                yield chunk
+
+        try:
+            for block in encoder.stream(source()):
+                compressed += len(block)
+                if block:
+                    yield block
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            self.count(encoder.name, size, compressed)
+
+
+def init_compression(app):
+    """Installs response compression on an app from its COMPRESS_* settings"""
+    algorithms = [name.strip() for name in app.config["COMPRESS_ALGORITHMS"].split(",") if name.strip()]
+    for name in algorithms:
+        if name not in ENCODERS:
+            app.logger.warning("Response compression: %s is not available in this worker", name)
+    compressor = Compressor(
+        algorithms,
+        app.config["COMPRESS_LEVEL"],
+        app.config["COMPRESS_MIN_SIZE"],
+        app.config["COMPRESS_MIMETYPES"],
+    )
+    if compressor.encoders:
+        app.after_request(compressor)
+    app.extensions["compression"] = compressor
+    app.logger.info(
+        "Response compression: %s level=%s min_size=%s",
+        ",".join(encoder.name for encoder in compressor.encoders) or "off",
+        app.config["COMPRESS_LEVEL"],
+        compressor.min_size,
+    )
+    return compressor
@@ -0,0 +1,106 @@
+"""
+Conditional Requests
+
+This module contains the helpers of the reads and writes that depend on
+the version of a representation. Reads send an ETag and answer a
+matching If-None-Match with 304 Not Modified, from the version of the
+Order alone when they can. Writes to an Order only
+apply while it is at the version an If-Match names, its ETag, and lose
+to another request that changed it first with 412 or 409.
+"""
+import hashlib
+from flask import Response, request, abort
+from service import app
+from service.common import status
+from service.models import db
+
+# The header of the writes that only apply to a given version of an Order
+IF_MATCH_PARAM = {"in": "header", "description": "The ETag of the Order"}
+
+
+def conditional_response(body: bytes, etag=None):
+    """
+    Sends a serialized representation with a strong ETag, of its content by default
+
+    A client that sends the ETag back in If-None-Match gets a 304 Not
+    Modified without the body when the representation has not changed.
+    """
+    etag = etag or hashlib.sha256(body).hexdigest()
+    headers = {"ETag": f'"{etag}"'}
+    if request.if_none_match.contains_weak(etag):
+        return "", status.HTTP_304_NOT_MODIFIED, headers
+    return Response(body, status.HTTP_200_OK, headers, mimetype="application/json")
+
+
+def version_etag(version, fields=None) -> str:
+    """
+    Returns the ETag of an Order, or of its Items, at a version
+
+    A representation of some of the fields has an ETag of its own, the
+    version followed by the fields, that never matches the whole one.
+    """
+    if not fields:
+        return str(version)
+    return f"{version};{','.join(sorted(fields))}"
+
+
+def not_modified(version, fields=None):
+    """
+    Answers a conditional read from the version of an Order alone
+
+    Returns:
+        A 304 Not Modified when If-None-Match has the ETag of the version,
+        otherwise None and the representation has to be loaded
+    """
+    if version is None:
+        return None
+    etag = version_etag(version, fields)
+    if request.if_none_match.contains_weak(etag):
+        return "", status.HTTP_304_NOT_MODIFIED, {"ETag": f'"{etag}"'}
+    return None
+
+
+def if_match_version():
+    """
+    Returns the Order version the If-Match header asks for
+
+    Returns None when any version will do, which is when there is no
+    If-Match, unless ORDERS_IF_MATCH_REQUIRED, or it is *. The ETag of
+    some of the fields names the version of the whole Order too.
+    """
+    if not request.if_match:
+        if app.config["ORDERS_IF_MATCH_REQUIRED"]:
+            abort(
+                status.HTTP_428_PRECONDITION_REQUIRED,
+                "If-Match with the ETag of the Order is required.",
+            )
+        return None
+    if request.if_match.star_tag:
+        return None
+    etags = request.if_match.as_set(include_weak=True)
+    etag = etags.pop().partition(";")[0] if len(etags) == 1 else ""
+    if not etag.isdigit():
+        abort(status.HTTP_412_PRECONDITION_FAILED, "If-Match must be the single ETag of the Order.")
+    return int(etag)
+
+
+def check_version(order, version):
+    """Aborts with 412 Precondition Failed when an Order is not at the version asked for"""
+    if version is not None and order.version != version:
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Order with id '{order.id}' is at version {order.version}, not {version}.",
+        )
+
+
+def conflict(order_id):
+    """
+    Aborts a write that lost to another request changing the same Order
+
+    The version checked by the UPDATE or DELETE no longer matched, so the
+    client gets 412 Precondition Failed when it sent If-Match and 409
+    Conflict otherwise, and should read the Order again.
+    """
+    db.session.rollback()
+    code = status.HTTP_412_PRECONDITION_FAILED if request.if_match else status.HTTP_409_CONFLICT
+    abort(code, f"Order with id '{order_id}' was changed by another request.")
@@ -0,0 +1,191 @@
+"""
+Group Commit
+
+This module contains the opt-in write path that saves the creates and
+updates arriving at the same time in one worker in a single transaction,
+so they share one commit (and one WAL flush) instead of paying for one
+each. The first write to arrive leads a batch: it waits up to
+GROUP_COMMIT_WINDOW seconds, or until GROUP_COMMIT_MAX_BATCH writes have
+joined, then runs every write in a savepoint of its own session and
+commits once. A write that fails only rolls back its savepoint, so every
+request still gets its own result or error.
+
+Writes only arrive at the same time when the worker serves requests
+concurrently, e.g. gunicorn --threads or a gevent worker.
+"""
+import time
+import logging
+import threading
+from flask import current_app, request
+from sqlalchemy.orm.exc import StaleDataError
+from service.common.conditional import conflict
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+
+class Write:
+    """A write waiting in a batch, and its outcome once the batch is done"""
+
+    def __init__(self, work):
+        self.work = work
+        self.arrived = time.monotonic()
+        self.instance = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batch:
+    """The writes gathered by one leader"""
+
+    def __init__(self):
+        self.writes = []
+        self.full = threading.Event()
+
+
+class GroupCommit:
+    """Batches the concurrent writes of a worker into shared transactions"""
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._lock = threading.Lock()
+        self._pending = None
+        self._counters = {"batches": 0, "writes": 0, "errors": 0, "wait": 0.0, "max_wait": 0.0}
+        self._sizes = {}
+
+    def submit(self, work) -> dict:
+        """
+        Saves a model instance in the next batch and returns it serialized
+
+        Args:
+            work: A callable that returns the new or changed instance to save,
+                it runs in the thread and session of the batch leader so it
+                must load whatever it changes itself
+
+        Raises:
+            Whatever work, the flush of its instance or the commit raised
+        """
+        write = Write(work)
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = Batch()
+            batch.writes.append(write)
+            if len(batch.writes) >= self.max_batch:
+                self._pending = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            self._run(batch.writes)
+        else:
+            write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _run(self, writes):
+        """Saves each write in a savepoint, commits them all and hands out the outcomes"""
+        started = time.monotonic()
+        session = db.session()
+        try:
+            for write in writes:
+                self._save(session, write)
+            # keep the attributes loaded, invalidate() reads them after the commit
+            expire_on_commit, session.expire_on_commit = session.expire_on_commit, False
+            try:
+                session.commit()
+            finally:
+                session.expire_on_commit = expire_on_commit
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Group commit of %s writes failed: %s", len(writes), error)
+            session.rollback()
+            for write in writes:
+                write.error = write.error or error
+        for write in writes:
+            if write.error is None:
+                write.instance.invalidate()
+            write.done.set()
+        self.count(writes, started)
+
+    @staticmethod
+    def _save(session, write):
+        """Runs a write in its own savepoint, keeping its error rather than raising it"""
+        try:
+            with session.begin_nested():
+                write.instance = write.work()
+                session.add(write.instance)
+                session.flush()
+                write.result = write.instance.serialize()
+        except Exception as error:  # pylint: disable=broad-except
+            write.error = error
+
+    def count(self, writes, started: float):
+        """Adds a batch to the counters"""
+        with self._lock:
+            counters = self._counters
+            counters["batches"] += 1
+            counters["writes"] += len(writes)
+            counters["errors"] += sum(1 for write in writes if write.error is not None)
+            for write in writes:
+                wait = started - write.arrived
+                counters["wait"] += wait
+                counters["max_wait"] = max(counters["max_wait"], wait)
+            self._sizes[len(writes)] = self._sizes.get(len(writes), 0) + 1
+
+    def stats(self) -> dict:
+        """Returns the batch sizes and the latency the batching added"""
+        with self._lock:
+            counters = self._counters
+            writes = counters["writes"]
+            return {
+                "window": self.window,
+                "max_batch": self.max_batch,
+                "batches": counters["batches"],
+                "writes": writes,
+                "errors": counters["errors"],
+                "mean_batch": writes / counters["batches"] if counters["batches"] else None,
+                "batch_sizes": dict(sorted(self._sizes.items())),
+                "mean_wait_ms": counters["wait"] / writes * 1000 if writes else None,
+                "max_wait_ms": counters["max_wait"] * 1000,
+            }
+
+
+def save(work, created=False):
+    """
+    Saves the instance work() returns and returns it serialized
+
+    With GROUP_COMMIT_ENABLED the write joins the next group commit, where
+    work() runs in the session of another request, otherwise it is saved
+    in a transaction of its own. An Order changed by another request since
+    work() loaded it is not saved, see conflict().
+    """
+    committer = current_app.extensions.get("group_commit")
+    try:
+        if committer is not None:
+            return committer.submit(work)
+        instance = work()
+        if created:
+            instance.create()
+        else:
+            instance.update()
+        return instance.serialize()
+    except StaleDataError:
+        return conflict(request.view_args.get("order_id"))
+
+
+def init_group_commit(app):
+    """Sets up the group commit of an app from its GROUP_COMMIT_* settings"""
+    if not app.config["GROUP_COMMIT_ENABLED"]:
+        return None
+    committer = GroupCommit(app.config["GROUP_COMMIT_WINDOW"], app.config["GROUP_COMMIT_MAX_BATCH"])
+    app.extensions["group_commit"] = committer
+    app.logger.info(
+        "Group commit: window=%ss max_batch=%s", committer.window, committer.max_batch
+    )
+    return committer
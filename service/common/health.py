@@ -0,0 +1,56 @@
+"""
+Health Checks
+
+This module contains the database check behind the readiness probe.
+The result is cached for a short time so that a storm of probes during
+a rollout costs the database at most one query per worker per TTL.
+"""
+import time
+import threading
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class CachedCheck:
+    """Runs a check at most once per TTL and remembers its result"""
+
+    def __init__(self, check):
+        self.check = check
+        self._lock = threading.Lock()
+        self._result = None
+        self._expires = 0.0
+
+    def __call__(self, ttl: float):
+        """Returns the cached result, running the check again once it expires"""
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._expires:
+                self._result = self.check()
+                self._expires = now + ttl
+            return self._result
+
+    def clear(self):
+        """Forgets the cached result so the next call runs the check"""
+        with self._lock:
+            self._expires = 0.0
+
+
+def check_database(engine, timeout: float):
+    """
+    Runs SELECT 1 on a pooled connection of the engine
+
+    The statement timeout only applies to the transaction of the check.
+
+    Returns:
+        None if the database answered, otherwise the error message
+    """
+    try:
+        with engine.connect() as connection:
+            connection.execute(
+                text("SELECT set_config('statement_timeout', :timeout, true)"),
+                {"timeout": str(int(timeout * 1000))},
+            )
+            connection.execute(text("SELECT 1"))
+    except SQLAlchemyError as error:
+        return str(error)
+    return None
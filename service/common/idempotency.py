@@ -0,0 +1,79 @@
+"""
+Idempotency Keys
+
+This module contains the decorator that makes a POST safe to retry with
+an Idempotency-Key header. The response to the first request with a key
+is stored, see IdempotencyKey, and a retry is answered with it instead
+of running again.
+"""
+import json
+import hashlib
+from functools import wraps
+from flask import Response, request, abort
+from flask_restx.utils import unpack
+from service import app, api
+from service.common import serializer, status
+from service.models import IdempotencyKey
+
+IDEMPOTENCY_KEY_PARAM = {"in": "header", "description": "Makes retries safe"}
+
+
+def request_fingerprint() -> str:
+    """Returns a hash of the method, path and JSON body of the request"""
+    body = json.dumps(request.get_json(silent=True), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{request.method} {request.path} {body}".encode("utf-8")).hexdigest()
+
+
+def replay(stored):
+    """Returns the response stored for an Idempotency-Key"""
+    headers = {"Idempotent-Replayed": "true"}
+    if stored.location:
+        headers["Location"] = stored.location
+    return Response(stored.body, stored.status, headers, mimetype="application/json")
+
+
+def idempotent(function):
+    """
+    Makes a POST safe to retry with an Idempotency-Key header
+
+    The first request with a key runs and its response is stored for
+    IDEMPOTENCY_TTL seconds. A retry with the same key and body is answered
+    with that response without running again, the same key with another
+    body is refused with 422 and a retry arriving while the first request
+    still runs with 409. A request that fails releases its key, and one
+    that never ends holds it for IDEMPOTENCY_LEASE seconds only.
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return function(*args, **kwargs)
+        if not key or len(key) > app.config["IDEMPOTENCY_KEY_MAX"]:
+            abort(status.HTTP_400_BAD_REQUEST, "Idempotency-Key must be 1 to 255 characters.")
+        fingerprint = request_fingerprint()
+        stored = IdempotencyKey.claim(key, fingerprint, app.config["IDEMPOTENCY_LEASE"])
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                abort(
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    f"Idempotency-Key '{key}' was used with another request.",
+                )
+            if stored.status is None:
+                abort(
+                    status.HTTP_409_CONFLICT,
+                    f"A request with Idempotency-Key '{key}' is in progress.",
+                )
+            app.logger.info("Replaying the response of Idempotency-Key %s", key)
+            return replay(stored)
+        try:
+            data, code, headers = unpack(function(*args, **kwargs))
+        except Exception:
+            IdempotencyKey.release(key)
+            raise
+        IdempotencyKey.complete(
+            key, code, serializer.dumps(data), headers.get("Location"), app.config["IDEMPOTENCY_TTL"]
+        )
+        return data, code, headers
+
+    return api.doc(params={"Idempotency-Key": IDEMPOTENCY_KEY_PARAM})(wrapper)
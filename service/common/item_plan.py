@@ -0,0 +1,54 @@
+"""
+Item Plans
+
+This module contains the helpers that turn the Items a request wants an
+Order to have into the changes to its current Items: the ones to insert,
+the ones to update and the ids to delete. An Item is matched by its id
+first and by its product otherwise, so a replaced list only writes the
+rows that changed.
+"""
+
+
+def plan_items(current, wanted):
+    """
+    Returns the Items to insert, the ones to update and the ids to delete
+
+    Args:
+        current: The (id, product_id, quantity, total) rows of the Items of an Order
+        wanted: The dicts of the Items it should have, their id is optional
+    """
+    by_id = {row.id: row for row in current}
+    matched = {}
+    unmatched = []
+    for item in wanted:
+        row = by_id.get(item_id(item))
+        if row is not None and row.id not in matched:
+            matched[row.id] = item
+        else:
+            unmatched.append(item)
+    by_product = {}
+    for row in current:
+        if row.id not in matched:
+            by_product.setdefault(row.product_id, []).append(row)
+    inserts = []
+    for item in unmatched:
+        rows = by_product.get(item["product_id"])
+        if rows:
+            matched[rows.pop(0).id] = item
+        else:
+            inserts.append({name: item[name] for name in ("product_id", "quantity", "total")})
+    updates = [
+        {**item, "id": row_id} for row_id, item in matched.items()
+        if (by_id[row_id].product_id, by_id[row_id].quantity, by_id[row_id].total)
+        != (item["product_id"], item["quantity"], item["total"])
+    ]
+    deletes = [row.id for row in current if row.id not in matched]
+    return inserts, updates, deletes
+
+
+def item_id(item):
+    """Returns the id an Item in a request refers to, None when it has none"""
+    try:
+        return int(item["id"])
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,135 @@
+"""
+Pagination Helpers
+
+This module contains utility functions for keyset (cursor) pagination.
+A cursor is an opaque token that encodes the (date, id) key of the
+row a page starts after, and the direction to walk in. Listings too long
+for pages are streamed in the same (date, id) order.
+"""
+import json
+import base64
+import logging
+import binascii
+from datetime import date
+from sqlalchemy import tuple_
+from service.models import DataValidationError, Order
+
+logger = logging.getLogger("flask.app")
+
+
+def encode_cursor(order, reverse=False) -> str:
+    """Builds an opaque cursor from the (date, id) key of an Order"""
+    key = {"d": order.date.isoformat(), "i": order.id, "r": reverse}
+    raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """
+    Decodes a cursor built by encode_cursor
+
+    Returns:
+        A tuple of ((date, id), reverse)
+
+    Raises:
+        DataValidationError: if the cursor cannot be decoded
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(raw)
+        return (date.fromisoformat(key["d"]), int(key["i"])), bool(key["r"])
+    except (binascii.Error, UnicodeDecodeError, TypeError, KeyError, ValueError) as error:
+        raise DataValidationError(f"Invalid cursor: {cursor}") from error
+
+
+def page_limit(limit, default: int, maximum: int) -> int:
+    """Returns the page size to use, capped at the server side maximum"""
+    if limit is None:
+        return min(default, maximum)
+    if limit < 1:
+        raise DataValidationError(f"Invalid limit: {limit}")
+    return min(limit, maximum)
+
+
+def link_header(links: dict) -> str:
+    """Formats a dict of {rel: url} as an RFC 8288 Link header"""
+    return ", ".join(f'<{url}>; rel="{rel}"' for rel, url in links.items())
+
+
+# The listing arguments the page links keep
+FORWARDED = ("customer_id", "status", "limit", "fields")
+
+
+def page_headers(url_for, args, orders, has_more, cursor, reverse) -> dict:
+    """
+    Returns a Link header pointing at the next and previous pages
+
+    Args:
+        url_for: Builds the url of the listing from its query string arguments
+        args (dict): The arguments of the listing, the FORWARDED ones are kept
+        orders: The Orders on this page
+        has_more: If there are more Orders beyond this page in the direction walked
+        cursor: The (date, id) key this page starts after, if any
+        reverse: If this page was walked to backwards
+    """
+    if not orders:
+        return {}
+    if reverse:
+        has_next, has_prev = cursor is not None, has_more
+    else:
+        has_next, has_prev = has_more, cursor is not None
+
+    params = {key: args[key] for key in FORWARDED if args[key] is not None}
+    links = {}
+    if has_next:
+        links["next"] = url_for(cursor=encode_cursor(orders[-1]), **params)
+    if has_prev:
+        links["prev"] = url_for(cursor=encode_cursor(orders[0], reverse=True), **params)
+    return {"Link": link_header(links)} if links else {}
+
+
+def find_page(query, limit, cursor=None, reverse=False):
+    """
+    Returns one page of Orders using keyset pagination on (date, id)
+
+    Orders are listed newest first. The page starts after the cursor key
+    so the database can seek straight to it instead of using an OFFSET.
+
+    Args:
+        query: The query of orders to page through.
+        limit: The maximum number of orders on the page.
+        cursor: The (date, id) key the page starts after, if any.
+        reverse: Walk backwards from the cursor to the previous page.
+
+    Returns:
+        A tuple of (orders, has_more) where has_more tells if there are
+        more orders beyond this page in the direction walked.
+    """
+    logger.info("Processing page of %s orders after %s", limit, cursor)
+    key = tuple_(Order.date, Order.id)
+    if reverse:
+        if cursor:
+            query = query.filter(key > tuple_(*cursor))
+        query = query.order_by(Order.date.asc(), Order.id.asc())
+    else:
+        if cursor:
+            query = query.filter(key < tuple_(*cursor))
+        query = query.order_by(Order.date.desc(), Order.id.desc())
+    orders = query.limit(limit + 1).all()
+    has_more = len(orders) > limit
+    orders = orders[:limit]
+    if reverse:
+        orders.reverse()
+    return orders, has_more
+
+
+def stream_rows(query, batch_size):
+    """
+    Iterates over every Order of a query, newest first
+
+    Rows are read from a server side cursor batch_size at a time so
+    only one batch of Orders is held in memory.
+    """
+    logger.info("Processing stream of orders in batches of %s", batch_size)
+    query = query.order_by(Order.date.desc(), Order.id.desc())
+    return query.yield_per(batch_size)
@@ -0,0 +1,189 @@
+"""
+Session Hooks
+
+This module contains the session events that keep the data derived from
+the Orders in step with the Orders and Items being written: the customer
+summaries, the item counters and version of an Order, and the negative
+cache entries of the ids a transaction creates. They run on every flush
+and commit of any session, so every write path, including group commit,
+keeps them right. The session of a request is also removed at its end.
+"""
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm.util import identity_key
+from service import app
+from service.models import db, BaseModel, CustomerSummary, Item, Order
+
+
+@app.teardown_request
+def remove_session(exception=None):  # pylint: disable=unused-argument
+    """
+    Removes the session of a request once it is answered
+
+    The app context is pushed for good in init_db(), so a request does not
+    get an app context, nor a session, of its own. Without this the session
+    and the objects it holds, not expired with DB_EXPIRE_ON_COMMIT=false,
+    would be kept from one request to the next.
+    """
+    db.session.remove()
+
+
+def order_delta(order, sign):
+    """Returns how adding (+1) or removing (-1) an Order changes its customer summary"""
+    state = inspect(order)
+    status = state.dict.get("status") or Order.__table__.c.status.server_default.arg
+    delta = {counter: 0 for counter in CustomerSummary.COUNTERS}
+    delta.update(customer_id=order.customer_id, order_count=sign, total=sign * order.total)
+    delta[CustomerSummary.STATUS_COUNTS[status]] = sign
+    delta["last_order_date"] = order.date if sign > 0 else None
+    return delta
+
+
+def merge_delta(deltas, delta):
+    """Adds a delta into the deltas of its customer"""
+    merged = deltas.get(delta["customer_id"])
+    if merged is None:
+        deltas[delta["customer_id"]] = delta
+        return
+    for counter in CustomerSummary.COUNTERS:
+        merged[counter] += delta[counter]
+    if delta["last_order_date"] and (
+        not merged["last_order_date"] or delta["last_order_date"] > merged["last_order_date"]
+    ):
+        merged["last_order_date"] = delta["last_order_date"]
+
+
+def merge_change(deltas, stale, order):
+    """Adds how a change to a persisted Order moves its customer summary"""
+    moved = get_history(order, "customer_id")
+    if moved.has_changes() or get_history(order, "date").has_changes():
+        stale.update(moved.deleted or (), moved.added or (), moved.unchanged or ())
+        return
+    status, total = get_history(order, "status"), get_history(order, "total")
+    if not (status.has_changes() or total.has_changes()):
+        return
+    if any(history.has_changes() and not history.deleted for history in (status, total)):
+        # The old value was expired before the change, so it is unknown
+        stale.add(order.customer_id)
+        return
+    delta = order_delta(order, 1)
+    delta.update(order_count=0, last_order_date=None)
+    delta[CustomerSummary.STATUS_COUNTS[(status.deleted or [order.status])[0]]] -= 1
+    delta["total"] -= (total.deleted or [order.total])[0]
+    merge_delta(deltas, delta)
+
+
+@event.listens_for(Session, "after_flush")
+def update_customer_summaries(session, flush_context):  # pylint: disable=unused-argument
+    """
+    Keeps the customer summaries in step with the Orders being flushed
+
+    New Orders and changes of status or total are applied as deltas. When
+    an Order is deleted or moves to another customer or date the last order
+    date may go back, so those customers are recomputed instead.
+    """
+    deltas, stale = {}, set()
+    for order in session.new:
+        if isinstance(order, Order):
+            merge_delta(deltas, order_delta(order, 1))
+    for order in session.deleted:
+        if isinstance(order, Order):
+            stale.add(order.customer_id)
+    for order in session.dirty:
+        if isinstance(order, Order) and session.is_modified(order):
+            merge_change(deltas, stale, order)
+
+    connection = session.connection()
+    for customer_id in stale:
+        deltas.pop(customer_id, None)
+    if deltas:
+        CustomerSummary.apply(connection, deltas)
+    CustomerSummary.refresh(connection, stale)
+
+
+def merge_items(counters, order_id, count, total):
+    """Adds Items to the pending counter changes of an Order"""
+    pending = counters.setdefault(order_id, [0, 0.0])
+    pending[0] += count
+    pending[1] += total
+
+
+def item_changes(session):
+    """Returns the (count, total) each persisted Order moves by in this flush"""
+    counters = {}
+    for item in session.new:
+        if isinstance(item, Item) and item.order is not None and item.order not in session.new:
+            merge_items(counters, item.order.id, 1, item.total)
+    for item in session.deleted:
+        if isinstance(item, Item):
+            merge_items(counters, item.order_id, -1, -item.total)
+    for item in session.dirty:
+        if not isinstance(item, Item) or not session.is_modified(item):
+            continue
+        moved, total = get_history(item, "order_id"), get_history(item, "total")
+        old_total = (total.deleted or [item.total])[0]
+        for order_id in moved.deleted or [item.order_id]:
+            merge_items(counters, order_id, -1, -old_total)
+        merge_items(counters, item.order_id, 1, item.total)
+    return counters
+
+
+@event.listens_for(Session, "before_flush")
+def count_order_items(session, flush_context, instances):  # pylint: disable=unused-argument
+    """
+    Keeps the item counters of the Orders in step with the Items being flushed
+
+    A new Order starts with the counters of its Items. Persisted Orders
+    are moved by the difference with a relative UPDATE, so concurrent
+    changes to the Items of one Order do not overwrite each other. The
+    UPDATE runs for every changed Item, even one that leaves the counters
+    as they were, so the version of its Order and its ETag move as well.
+    """
+    for order in session.new:
+        if isinstance(order, Order):
+            order.item_count = len(order.items)
+            order.items_total = sum(item.total for item in order.items)
+
+    connection = session.connection()
+    for order_id, (count, total) in item_changes(session).items():
+        order = session.identity_map.get(identity_key(Order, order_id))
+        if order_id is None or order in session.deleted:
+            continue
+        values = Order.add_items(connection, order_id, count, total)
+        if values is not None and order is not None:
+            set_committed_value(order, "item_count", values.item_count)
+            set_committed_value(order, "items_total", values.items_total)
+            # Only own this bump, a concurrent change must still fail the version check
+            if values.version == get_history(order, "version").unchanged[0] + 1:
+                set_committed_value(order, "version", values.version)
+
+
+@event.listens_for(Session, "after_flush")
+def collect_created(session, flush_context):  # pylint: disable=unused-argument
+    """Remembers the ids created in a transaction until it commits"""
+    created = session.info.setdefault("created", [])
+    created.extend(
+        instance.missing_key(instance.id) for instance in session.new
+        if isinstance(instance, BaseModel)
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def forget_created(session):
+    """
+    Drops the negative cache entries of the ids created in a transaction
+
+    This runs after the commit, and a shared cache drops the entries by
+    bumping their version, so a lookup that missed before the commit
+    cannot store an entry the new row would then hide behind.
+    """
+    created = session.info.pop("created", None)
+    if created:
+        BaseModel.missing.delete_many(created)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_created(session):
+    """Forgets the ids of a transaction that was rolled back"""
+    session.info.pop("created", None)
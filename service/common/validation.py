@@ -0,0 +1,75 @@
+"""
+Column Checks
+
+This module checks the values a request sets against the columns they
+are written to: null where the column needs a value, the values of an
+enum, the length of a string and the range of an integer. A bad value is
+refused with a message naming its field instead of failing the INSERT or
+UPDATE it is part of. Numbers sent as strings are converted, as the
+database would.
+"""
+from datetime import date
+from sqlalchemy import Date, Enum, Float, Integer, String
+
+# The range of a Postgres integer column
+INTEGER_RANGE = (-2**31, 2**31 - 1)
+
+
+def check_values(table, values: dict) -> dict:
+    """
+    Returns the values converted to the types of their columns
+
+    Args:
+        table: The table the values are written to
+        values (dict): The values keyed by column name
+
+    Raises:
+        ValueError: naming the first value that does not fit its column
+    """
+    checked = {}
+    for name, value in values.items():
+        column = table.c[name]
+        if value is None:
+            if not column.nullable and column.default is None and column.server_default is None:
+                raise ValueError(f"missing {name}")
+            checked[name] = value
+            continue
+        try:
+            checked[name] = convert(column.type, value)
+        except ValueError as error:
+            raise ValueError(f"{name} {error.args[0]}") from error
+    return checked
+
+
+def convert(kind, value):
+    """Returns a value as the type of a column, raising ValueError when it does not fit"""
+    if isinstance(kind, Enum):
+        if value not in kind.enums:
+            raise ValueError("must be one of " + ", ".join(kind.enums))
+    elif isinstance(kind, String):
+        if not isinstance(value, str):
+            raise ValueError("must be a string")
+        if kind.length and len(value) > kind.length:
+            raise ValueError(f"must be at most {kind.length} characters")
+    elif isinstance(kind, Integer):
+        value = to_number(value, int)
+        if not INTEGER_RANGE[0] <= value <= INTEGER_RANGE[1]:
+            raise ValueError("is out of range")
+    elif isinstance(kind, Float):
+        value = to_number(value, float)
+    elif isinstance(kind, Date) and not isinstance(value, date):
+        raise ValueError("must be a date")
+    return value
+
+
+def to_number(value, kind):
+    """Returns a number, or a string holding one, as an int or a float"""
+    problem = "must be an integer" if kind is int else "must be a number"
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(problem)
+    if kind is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError(problem)
+    try:
+        return kind(value)
+    except (OverflowError, ValueError) as error:
+        raise ValueError(problem) from error
@@ -0,0 +1,126 @@
+"""
+Worker Warm-up
+
+This module contains the optional warm-up a worker runs at start, right
+after the database is initialized and before it serves any request, the
+readiness probe included. It opens the connections of the pool, runs
+the hot finder queries once so their SQL is compiled and their pages
+are in the database buffers, and preloads the newest Orders into the
+cache, unless there is none to fill. Every step checks a shared time budget and the warm-up stops
+where it is once the budget is spent.
+"""
+import time
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from service.common.cache import NullCache
+from service.common.pagination import find_page
+from service.models import db, Order, Item, CustomerSummary
+
+logger = logging.getLogger("flask.app")
+
+
+class WarmUp:
+    """Runs the warm-up steps of a worker within a time budget"""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.deadline = time.monotonic() + budget
+        self.counters = {"connections": 0, "queries": 0, "orders": 0}
+        self.skipped = []
+
+    def left(self) -> float:
+        """Returns the seconds left in the budget"""
+        return self.deadline - time.monotonic()
+
+    def open_pool(self, size: int):
+        """Opens size pooled connections at once so they stay in the pool"""
+        connections = []
+        try:
+            while len(connections) < size and self.left() > 0:
+                connection = db.engine.connect()
+                connections.append(connection)
+                connection.execute(text("SELECT 1"))
+                self.counters["connections"] += 1
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def run_finders(self, page_size: int):
+        """Runs each hot finder query once"""
+        orders, _ = find_page(Order.base_query(), page_size)
+        queries = [lambda: find_page(Order.find_by_status("OPEN"), page_size)]
+        if orders:
+            order = orders[0]
+            queries += [
+                lambda: find_page(Order.find_by_customer_id(order.customer_id), page_size),
+                lambda: Order.find_by_customer_id_and_status(order.customer_id, order.status).first(),
+                lambda: Order.find(order.id),
+                lambda: Item.find_by_order_id(order.id).all(),
+                lambda: CustomerSummary.find(order.customer_id),
+            ]
+        self.counters["queries"] += 1
+        for query in queries:
+            if self.left() <= 0:
+                return
+            query()
+            self.counters["queries"] += 1
+
+    def preload(self, count: int, batch_size: int):
+        """Caches the newest Orders, batch_size at a time"""
+        cursor = None
+        while self.counters["orders"] < count and self.left() > 0:
+            limit = min(batch_size, count - self.counters["orders"])
+            orders, has_more = find_page(Order.base_query(), limit, cursor)
+            for order in orders:
+                Order.cache.set(order.id, order.serialize())
+            self.counters["orders"] += len(orders)
+            if not has_more:
+                return
+            cursor = (orders[-1].date, orders[-1].id)
+
+    def run(self, steps) -> dict:
+        """Runs (name, step) pairs in order and returns what was done"""
+        started = time.monotonic()
+        for name, step in steps:
+            if self.left() <= 0:
+                self.skipped.append(name)
+                continue
+            try:
+                step()
+            except SQLAlchemyError as error:
+                logger.warning("Warm-up step %s failed: %s", name, error)
+                self.skipped.append(name)
+            finally:
+                # hand the connection back and let go of the loaded Orders
+                db.session.remove()
+        return {
+            **self.counters,
+            "completed": not self.skipped,
+            "skipped": self.skipped,
+            "duration": round(time.monotonic() - started, 3),
+        }
+
+
+def warm_up(app) -> dict:
+    """Warms up this worker as set by the WARMUP_* settings"""
+    config = app.config
+    warmup = WarmUp(config["WARMUP_BUDGET"])
+    steps = [
+        ("pool", lambda: warmup.open_pool(config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"])),
+        ("finders", lambda: warmup.run_finders(config["ORDERS_PAGE_SIZE"])),
+    ]
+    # the null cache would drop every preloaded Order
+    if not isinstance(Order.cache, NullCache):
+        steps.append(("cache", lambda: warmup.preload(config["WARMUP_ORDERS"], config["ORDERS_PAGE_SIZE"])))
+    result = warmup.run(steps)
+    app.logger.info(
+        "Warm-up %s in %ss: %s connections, %s queries, %s orders cached, skipped %s",
+        "completed" if result["completed"] else "stopped",
+        result["duration"],
+        result["connections"],
+        result["queries"],
+        result["orders"],
+        result["skipped"] or "nothing",
+    )
+    return result
@@ -13,5 +13,94 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 ERROR_404_HELP = False
 
+
+def getenv_bool(name, default):
+    """Reads a true/false flag from the environment"""
+    return os.getenv(name, default).lower() in ("true", "yes", "1")
+
+
+# Connection pool of each gunicorn worker. A sync worker serves one request
+# at a time so a small pool plus a little overflow is all it needs.
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "2")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "3")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": getenv_bool("DB_POOL_PRE_PING", "true"),
+    "connect_args": {
+        "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
+        "options": f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT', '30000'))}",
+    },
+}
+# The maintenance CLI commands lift the statement timeout for their transaction.
+# DB_EXPIRE_ON_COMMIT=false keeps the objects loaded after a commit, which only
+# lasts as long as the request since its session is removed once it is answered.
+SQLALCHEMY_EXPIRE_ON_COMMIT = getenv_bool("DB_EXPIRE_ON_COMMIT", "true")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Keyset pagination for order listings
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "100"))
+ORDERS_PAGE_MAX = int(os.getenv("ORDERS_PAGE_MAX", "1000"))
+
+# Rows fetched per round trip when streaming order listings
+ORDERS_STREAM_BATCH = int(os.getenv("ORDERS_STREAM_BATCH", "500"))
+
+# Refuse order updates and cancels without an If-Match of the order version
+ORDERS_IF_MATCH_REQUIRED = getenv_bool("ORDERS_IF_MATCH_REQUIRED", "false")
+
+# Bulk order creation: largest batch accepted and rows flushed per INSERT
+ORDERS_BATCH_MAX = int(os.getenv("ORDERS_BATCH_MAX", "10000"))
+ORDERS_BATCH_CHUNK = int(os.getenv("ORDERS_BATCH_CHUNK", "1000"))
+
+# Warm-up at worker start: open the pool, run the hot finders and cache the
+# newest orders, for at most WARMUP_BUDGET seconds before serving requests
+WARMUP_ENABLED = getenv_bool("WARMUP_ENABLED", "false")
+WARMUP_BUDGET = float(os.getenv("WARMUP_BUDGET", "10"))
+WARMUP_ORDERS = int(os.getenv("WARMUP_ORDERS", "1000"))
+
+# Idempotency-Key of order and item creation: seconds a response is replayed
+# for, seconds a key stays claimed by a request that never finished (keep it
+# over the gunicorn worker timeout) and the longest key accepted
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LEASE = int(os.getenv("IDEMPOTENCY_LEASE", "60"))
+IDEMPOTENCY_KEY_MAX = 255
+
+# Group commit: creates and updates of orders arriving together in a worker
+# are saved in one transaction, the first one waits up to GROUP_COMMIT_WINDOW
+# seconds for up to GROUP_COMMIT_MAX_BATCH writes. Needs a threaded worker.
+GROUP_COMMIT_ENABLED = getenv_bool("GROUP_COMMIT_ENABLED", "false")
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.002"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "32"))
+
+# Readiness probe: seconds a database check result is reused, and its timeout
+HEALTH_CHECK_TTL = float(os.getenv("HEALTH_CHECK_TTL", "5"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+
+# Read-through cache of serialized orders: "null" (no cache), "memory" (per
+# worker LRU), "redis" (shared by every worker, CACHE_URL is redis://...) or
+# "sqlite" (shared by the workers of one host, CACHE_URL is a file path).
+# With "memory" each worker has its own copy and serves a write made on another
+# one stale for up to CACHE_TTL, ETag included, so it only suits a single worker.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "null")
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "orders")
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+
+# Negative cache of order and item ids that were not found, on the same backend,
+# so off with "null". With "memory" it holds up to CACHE_MISSING_MAXSIZE ids per
+# worker, on a shared backend every entry expires after CACHE_MISSING_TTL.
+# Creates clear their ids, so the TTL only bounds how long it holds entries.
+CACHE_MISSING_TTL = float(os.getenv("CACHE_MISSING_TTL", "5"))
+CACHE_MISSING_MAXSIZE = int(os.getenv("CACHE_MISSING_MAXSIZE", "10000"))
+
+# Response compression: encodings in order of preference (br and zstd need the
+# brotli and zstandard packages of requirements.txt, and are left out without
+# them), their level and the smallest body compressed.
+# Streamed responses are always compressed since their size is not known.
+COMPRESS_ALGORITHMS = os.getenv("COMPRESS_ALGORITHMS", "zstd,br,gzip")
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_MIMETYPES = ("application/json", "application/x-ndjson")
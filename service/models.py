@@ -1,12 +1,24 @@
 """
 Models for Order
 
-All of the models are stored in this module
+All of the models are stored in this module, the session events that keep
+the data derived from them in step are in service.common.session_hooks
 """
+# pylint: disable=too-many-lines
 import logging
-from datetime import date
+from datetime import date, timedelta
 from abc import abstractmethod
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    Values, column, delete, exists, func, insert, literal, or_, select, update
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+from sqlalchemy.orm.attributes import flag_modified
+from service.common.cache import NullCache, make_cache
+from service.common.item_plan import plan_items
+from service.common.validation import check_values
 
 
 logger = logging.getLogger("flask.app")
@@ -29,6 +41,11 @@ class BaseModel:
     """
     A base class of data model that other order and Item models can inherit from
     """
+    # Read-through cache of serialized Orders keyed by order id, see init_db()
+    cache = NullCache()
+    # Negative cache of the ids find() did not find, keyed by "table:id"
+    missing = NullCache()
+
     def __init__(self):
         self.id = None  # pylint: disable=invalid-name
 
@@ -40,6 +57,47 @@ class BaseModel:
     def deserialize(self, data):
         """ Convert a dictionary to an object """
 
+    @abstractmethod
+    def invalidate(self):
+        """ Drops the cached copies this object is part of """
+
+    @classmethod
+    def parse_changes(cls, data) -> dict:
+        """
+        Returns the columns a partial update sets from a dictionary of changed fields
+
+        The values are checked against their columns and converted to their
+        types, as deserialize() does for a whole object.
+
+        Raises:
+            DataValidationError: when there are no changes, or a field cannot
+                be changed, is set to null or does not fit its column
+        """
+        name = cls.__name__.lower()
+        if not isinstance(data, dict) or not data:
+            raise DataValidationError(f"Invalid {name}: body of request contained no changes")
+        unknown = sorted(set(data) - set(cls.PATCHABLE))
+        if unknown:
+            raise DataValidationError(f"Invalid {name}: cannot change " + ", ".join(unknown))
+        missing = sorted(field for field, value in data.items() if value is None)
+        if missing:
+            raise DataValidationError(f"Invalid {name}: missing " + ", ".join(missing))
+        try:
+            return check_values(cls.__table__, data)
+        except ValueError as error:
+            raise DataValidationError(f"Invalid {name}: " + error.args[0]) from error
+
+    def check_columns(self, names):
+        """
+        Checks the given fields against their columns, see check_values()
+
+        Raises:
+            ValueError: naming the first field that does not fit its column
+        """
+        values = check_values(self.__table__, {name: getattr(self, name) for name in names})
+        for name, value in values.items():
+            setattr(self, name, value)
+
     def create(self):
         """
         Creates a Order to the database
@@ -48,6 +106,32 @@ class BaseModel:
         self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
         db.session.commit()
+        self.invalidate()
+
+    @classmethod
+    def create_many(cls, instances, chunk_size=1000):
+        """
+        Creates many instances in a single transaction
+
+        The session is flushed chunk_size instances at a time so that rows
+        are sent as multi-row INSERT ... RETURNING statements rather than
+        one INSERT and one commit per instance. Nothing is saved if any
+        row is rejected by the database.
+        """
+        logger.info("Creating %s %s instances", len(instances), cls.__name__)
+        for instance in instances:
+            instance.id = None
+        try:
+            for start in range(0, len(instances), chunk_size):
+                db.session.add_all(instances[start:start + chunk_size])
+                db.session.flush()
+            db.session.commit()
+        except (DataError, IntegrityError) as error:
+            db.session.rollback()
+            logger.error("Batch of %s rejected by the database: %s", len(instances), error.orig)
+            raise DataValidationError(
+                f"Invalid batch: a {cls.__name__.lower()} was rejected by the database"
+            ) from error
 
     def update(self):
         """
@@ -55,12 +139,14 @@ class BaseModel:
         """
         logger.info("Saving %s", self.id)
         db.session.commit()
+        self.invalidate()
 
     def delete(self):
         """ Removes a Order from the data store """
         logger.info("Deleting %s", self.id)
         db.session.delete(self)
         db.session.commit()
+        self.invalidate()
 
     @classmethod
     def init_db(cls, app):
@@ -70,7 +156,17 @@ class BaseModel:
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        db.session.configure(expire_on_commit=app.config.get("SQLALCHEMY_EXPIRE_ON_COMMIT", True))
         db.create_all()  # make our sqlalchemy tables
+        BaseModel.cache = make_cache(app.config)
+        # a memory cache only sees the ids created by its own worker, as it
+        # only sees its writes, and the null backend keeps no negative cache
+        BaseModel.missing = make_cache(
+            app.config,
+            ttl=app.config.get("CACHE_MISSING_TTL", 5.0),
+            maxsize=app.config.get("CACHE_MISSING_MAXSIZE", 10000),
+            prefix="missing",
+        )
 
     @classmethod
     def all(cls):
@@ -79,10 +175,52 @@ class BaseModel:
         return cls.query.all()
 
     @classmethod
-    def find(cls, by_id):
-        """ Finds a Order by it's ID """
+    def find(cls, by_id, fields=None):
+        """
+        Finds a Order by it's ID, loading only the given fields if any
+
+        An id that was not found a moment ago is answered from the negative
+        cache without a query.
+        """
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        missing, stamp = cls.missing.lookup(cls.missing_key(by_id))
+        if missing:
+            return None
+        if fields:
+            found = cls.load_fields(cls.query, fields).filter(cls.id == by_id).first()
+        else:
+            found = cls.query.get(by_id)
+        if found is None:
+            cls.remember_missing(by_id, stamp)
+        return found
+
+    @classmethod
+    def missing_key(cls, by_id) -> str:
+        """Returns the negative cache key of an id"""
+        return f"{cls.__tablename__}:{by_id}"
+
+    @classmethod
+    def remember_missing(cls, by_id, stamp):
+        """
+        Stores in the negative cache that an id was not found
+
+        Ids from the sequence commit out of order, so an id may be missing
+        only until the transaction that holds it commits. The negative cache
+        is shared, or in the worker of a memory cache, see init_db(), and
+        that commit drops the entry, see forget_created().
+        """
+        cls.missing.set(cls.missing_key(by_id), True, stamp)
+
+    @classmethod
+    def load_fields(cls, query, fields):
+        """
+        Narrows the columns a query loads to the given fields
+
+        The primary key is always loaded. Fields that are not columns,
+        like relationships, are left for the caller to load.
+        """
+        columns = [getattr(cls, name) for name in fields if name in cls.__table__.columns]
+        return query.options(load_only(cls.id, *columns))
 
 
 ##################################################
@@ -96,20 +234,30 @@ class Item(db.Model, BaseModel):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     product_id = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
-    total = db.Column(db.Float, nullable=False)
-    order_id = db.Column(
-        db.Integer, db.ForeignKey("order.id", ondelete="CASCADE"), nullable=False
+    # The old total and order_id are loaded on change to update the Order counters
+    total = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
+    order_id = db.column_property(
+        db.Column(
+            db.Integer, db.ForeignKey("order.id", ondelete="CASCADE"), nullable=False, index=True
+        ),
+        active_history=True,
     )
 
-    def serialize(self) -> dict:
-        """Serialize an Order into a dict"""
-        return {
-            "id": self.id,
-            "product_id": self.product_id,
-            "quantity": self.quantity,
-            "total": self.total,
-            "order_id": self.order_id,
-        }
+    FIELDS = ("id", "product_id", "quantity", "total", "order_id")
+    # The fields a PATCH may change
+    PATCHABLE = ("product_id", "quantity", "total")
+
+    def serialize(self, fields=None) -> dict:
+        """
+        Serialize an Item into a dict
+        Args:
+            fields (list): Only serialize these fields, defaults to all of them
+        """
+        return {name: getattr(self, name) for name in fields or self.FIELDS}
+
+    def invalidate(self):
+        """ Drops the cached copy of the Order this Item belongs to """
+        self.cache.delete(self.order_id)
 
     def deserialize(self, data: dict):
         """
@@ -120,23 +268,243 @@ class Item(db.Model, BaseModel):
         try:
             self.product_id = data["product_id"]
             self.quantity = data["quantity"]
+            self.total = data["total"]
+            self.check_columns(("product_id", "quantity", "total"))
             if self.quantity < 1:
                 raise DataValidationError("Invalid quantity detected in item product: "
                                           + str(data["quantity"]))
-            self.total = data["total"]
         except KeyError as error:
             raise DataValidationError("Invalid item: missing " + error.args[0]) from error
         except TypeError as error:
             raise DataValidationError(
                 "Invalid item: body of request contained bad or no data " + str(error)
             ) from error
+        except ValueError as error:
+            raise DataValidationError("Invalid item: " + error.args[0]) from error
         return self
 
+    @classmethod
+    def parse_changes(cls, data) -> dict:
+        """Returns the columns a partial update of an Item sets, see BaseModel.parse_changes()"""
+        changes = super().parse_changes(data)
+        if "quantity" in changes and changes["quantity"] < 1:
+            raise DataValidationError(
+                "Invalid quantity detected in item product: " + str(changes["quantity"])
+            )
+        return changes
+
+    @classmethod
+    def patch(cls, order_id, by_id, changes):
+        """
+        Changes some fields of an Item of an Order in one statement
+
+        The UPDATE of the Item and the UPDATE of the items_total and version
+        of its Order run as data modifying CTEs of a single statement, so
+        neither the Item nor the Order is loaded.
+
+        Returns:
+            The serialized Item, or None if the Order has no Item with the id
+        """
+        logger.info("Patching item %s of order %s", by_id, order_id)
+        try:
+            order_id, by_id = int(order_id), int(by_id)
+        except (TypeError, ValueError):
+            return None
+        items, orders = cls.__table__, Order.__table__
+        old = (
+            select(items.c.id, items.c.total)
+            .where(items.c.id == by_id, items.c.order_id == order_id)
+            .with_for_update()
+            .subquery("old")
+        )
+        changed = (
+            update(items)
+            .where(items.c.id == old.c.id)
+            .values(**changes)
+            .returning(*[items.c[name] for name in cls.FIELDS], old.c.total.label("old_total"))
+            .cte("changed")
+        )
+        counted = (
+            update(orders)
+            .where(orders.c.id == changed.c.order_id)
+            .values(
+                items_total=orders.c.items_total + changed.c.total - changed.c.old_total,
+                version=orders.c.version + 1,
+            )
+            .returning(orders.c.id)
+            .cte("counted")
+        )
+        statement = select(*[changed.c[name] for name in cls.FIELDS]).add_cte(counted)
+        try:
+            row = db.session.execute(statement).first()
+            db.session.commit()
+        except (DataError, IntegrityError) as error:
+            db.session.rollback()
+            logger.error("Patch of item %s rejected by the database: %s", by_id, error.orig)
+            raise DataValidationError(
+                "Invalid item: the changes were rejected by the database"
+            ) from error
+        if row is None:
+            return None
+        cls.cache.delete(order_id)
+        return row._asdict()
+
+    @classmethod
+    def write_plan(cls, order_id, inserts, updates, deletes):
+        """Writes the Item changes of plan_items() with one statement of each kind"""
+        items = cls.__table__
+        if deletes:
+            db.session.execute(delete(items).where(items.c.id.in_(deletes)))
+        if updates:
+            names = ("id", *cls.PATCHABLE)
+            changes = Values(
+                *[column(name, items.c[name].type) for name in names], name="changes"
+            ).data([tuple(item[name] for name in names) for item in updates])
+            db.session.execute(
+                update(items)
+                .where(items.c.id == changes.c.id)
+                .values({name: changes.c[name] for name in cls.PATCHABLE})
+            )
+        if inserts:
+            rows = db.session.execute(
+                insert(items).returning(items.c.id),
+                [{**item, "order_id": order_id} for item in inserts],
+            ).all()
+            # the new ids may be in the negative cache, forget_created() drops them
+            created = db.session.info.setdefault("created", [])
+            created.extend(cls.missing_key(row.id) for row in rows)
+
+    @classmethod
+    def read_whole_order(cls, fields):
+        """
+        Tells if Items are read through the whole cached Order
+
+        That is worth loading the Order and its Items only to read all the
+        fields, and only when the Order is then cached for the next read.
+        """
+        return not fields and not isinstance(Order.cache, NullCache)
+
+    @classmethod
+    def find_serialized(cls, order_id, by_id, fields=None):
+        """
+        Returns the serialized Item with the given id in the Order with the given id
+
+        The Item is read from the cached Order it belongs to when there is
+        one, and otherwise with a query of that Item alone, narrowed to the
+        given fields if any.
+
+        Returns:
+            The serialized Item, or None if there is no such Item in the Order
+        """
+        try:
+            order_id, by_id = int(order_id), int(by_id)
+        except (TypeError, ValueError):
+            return None
+        if cls.read_whole_order(fields):
+            order = Order.find_serialized(order_id)
+        else:
+            order, _ = Order.cache.lookup(order_id)
+        for data in order["items"] if order else ():
+            if data["id"] == by_id:
+                return {name: data[name] for name in fields} if fields else data
+        query = cls.load_fields(cls.query, fields) if fields else cls.query
+        item = query.filter(cls.id == by_id, cls.order_id == order_id).first()
+        return item.serialize(fields) if item else None
+
+    @classmethod
+    def find_all_serialized(cls, order_id, fields=None):
+        """
+        Returns the version of the Order with the given id and its serialized Items
+
+        The Items are read from the cached Order when there is one, and
+        otherwise with a query of the Items alone, narrowed to the given
+        fields if any, after the version so it is never newer than them.
+
+        Returns:
+            The version and the serialized Items, or None if there is no
+            Order with the id
+        """
+        try:
+            order_id = int(order_id)
+        except (TypeError, ValueError):
+            return None
+        if cls.read_whole_order(fields):
+            order = Order.find_serialized(order_id)
+            return (order["version"], order["items"]) if order else None
+        order, _ = Order.cache.lookup(order_id)
+        if order is not None:
+            items = [{name: data[name] for name in fields} for data in order["items"]] if fields else order["items"]
+            return order["version"], items
+        version = Order.find_version(order_id)
+        if version is None:
+            return None
+        query = cls.load_fields(cls.query, fields) if fields else cls.query
+        items = query.filter(cls.order_id == order_id).order_by(cls.id)
+        return version, [item.serialize(fields) for item in items]
+
+    def create_for_order(self, order_id):
+        """
+        Adds this Item to an Order that is not cancelled in one statement
+
+        The guarded UPDATE of the Order counters and the INSERT of the Item
+        run as a single INSERT ... SELECT from a data modifying CTE, so
+        neither the Order nor its Items are loaded and the cost does not
+        grow with the number of Items. The UPDATE locks the Order row, so
+        a concurrent cancel either waits or makes the guard fail.
+
+        Returns:
+            True if the Item was added, False if there is no such Order or
+            it is cancelled
+        """
+        logger.info("Creating an item for order %s", order_id)
+        try:
+            order_id = int(order_id)
+        except (TypeError, ValueError):
+            return False
+        orders, items = Order.__table__, Item.__table__
+        target = (
+            update(orders)
+            .where(orders.c.id == order_id, orders.c.status != "CANCELLED")
+            .values(
+                item_count=orders.c.item_count + 1,
+                items_total=orders.c.items_total + self.total,
+                version=orders.c.version + 1,
+            )
+            .returning(orders.c.id)
+            .cte("target")
+        )
+        values = select(
+            literal(self.product_id, items.c.product_id.type),
+            literal(self.quantity, items.c.quantity.type),
+            literal(self.total, items.c.total.type),
+            target.c.id,
+        )
+        statement = (
+            insert(items)
+            .from_select(["product_id", "quantity", "total", "order_id"], values)
+            .add_cte(target)
+            .returning(items.c.id, items.c.order_id)
+        )
+        row = db.session.execute(statement).first()
+        db.session.commit()
+        if row is None:
+            return False
+        self.id, self.order_id = row.id, row.order_id
+        self.invalidate()
+        self.missing.delete(self.missing_key(self.id))
+        return True
+
+    @classmethod
+    def find_by_order_id(cls, order_id):
+        """Returns all Items of the Order with the given id"""
+        logger.info("Processing order id query for %s ...", order_id)
+        return cls.query.filter(cls.order_id == order_id)
+
 
 ##################################################
 # ORDER MODEL
 ##################################################
-class Order(db.Model, BaseModel):
+class Order(db.Model, BaseModel):  # pylint: disable=too-many-instance-attributes
     """
     A Class that represent Order Model
     """
@@ -148,38 +516,77 @@ class Order(db.Model, BaseModel):
         nullable=False
     )
     address = db.Column(db.String(100), nullable=False)
-    customer_id = db.Column(db.Integer, nullable=False)
+    # The old customer_id is loaded on change so its summary can be updated
+    customer_id = db.column_property(db.Column(db.Integer, nullable=False), active_history=True)
     status = db.Column(
         db.Enum("OPEN", "SHIPPING", "DELIVERED", "CANCELLED", name="status_enum"),
         nullable=False,
         server_default="OPEN"
     )
+    # Kept in step with the Items by session_hooks.count_order_items() so reads skip the join
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    items_total = db.Column(db.Float, nullable=False, default=0.0, server_default="0")
+    # Bumped by every change to the Order or its Items, sent as the ETag
+    version = db.Column(db.Integer, nullable=False, server_default="1")
     items = db.relationship("Item", backref="order", passive_deletes=True)
 
+    # The UPDATE and DELETE of a loaded Order only apply while it still is at
+    # the version it was loaded at, and raise StaleDataError otherwise
+    __mapper_args__ = {"version_id_col": version}
+
+    # The statuses an Order may move to each status from
+    TRANSITIONS = {
+        "OPEN": (),
+        "SHIPPING": ("OPEN",),
+        "DELIVERED": ("SHIPPING",),
+        "CANCELLED": ("OPEN",),
+    }
+
+    # Indexes for the finders and for keyset pagination on (date, id)
+    __table_args__ = (
+        db.Index("ix_order_customer_id_status", "customer_id", "status"),
+        db.Index("ix_order_status_date", "status", "date"),
+        db.Index("ix_order_date_id", "date", "id"),
+    )
+
     def __repr__(self):
         return f"<Order id=[{self.id}]>"
 
-    def serialize(self) -> dict:
-        """Serialize an Order into a dict"""
-        order = {
-            "id": self.id,
-            "date": self.date.isoformat(),
-            "total": self.total,
-            "payment": self.payment,
-            "address": self.address,
-            "customer_id": self.customer_id,
-            "status": self.status,
-            "items": []
-        }
-        for product in self.items:
-            order["items"].append(product.serialize())
+    FIELDS = (
+        "id", "date", "total", "payment", "address", "customer_id", "status",
+        "item_count", "items_total", "version", "items",
+    )
+    # The fields a PATCH may change, and the ones the customer summary counts
+    PATCHABLE = ("date", "total", "payment", "address", "customer_id", "status")
+    SUMMARIZED = {"date", "total", "customer_id", "status"}
+
+    def serialize(self, fields=None) -> dict:
+        """
+        Serialize an Order into a dict
+        Args:
+            fields (list): Only serialize these fields, defaults to all of them
+        """
+        order = {}
+        for name in fields or self.FIELDS:
+            if name == "date":
+                order["date"] = self.date.isoformat()
+            elif name == "items":
+                order["items"] = [product.serialize() for product in self.items]
+            else:
+                order[name] = getattr(self, name)
         return order
 
-    def deserialize(self, data: dict):
+    def invalidate(self):
+        """ Drops the cached copy of this Order """
+        self.cache.delete(self.id)
+
+    def deserialize(self, data: dict, with_items=True):
         """
         Deserializes an Order from a dictionary
         Args:
             data (dict): A dictionary containing the Order data
+            with_items (bool): Append the Items in the data, see replace_items()
+                to make them the Items of a persisted Order instead
         """
         try:
             # assert(isinstance(data["total"],float), "total")
@@ -189,8 +596,9 @@ class Order(db.Model, BaseModel):
             self.address = data["address"]
             self.customer_id = data["customer_id"]
             self.status = data.get("status")
+            self.check_columns(("total", "payment", "address", "customer_id", "status"))
             items = data.get("items")
-            if items:
+            if items and with_items:
                 for json_product in items:
                     product = Item()
                     product.deserialize(json_product)
@@ -203,29 +611,546 @@ class Order(db.Model, BaseModel):
             raise DataValidationError("Invalid order: " + error.args[0]) from error
         return self
 
+    def replace_items(self, data: list):
+        """
+        Makes the given Items the Items of this persisted Order
+
+        The Items in the data are matched to the current ones by id, then
+        by product_id, and only the differences are written: one DELETE,
+        one UPDATE from a VALUES list and one multi-row INSERT at most,
+        whatever the number of Items. The Items are not loaded as objects,
+        the item counters are set from the data and the Order is marked
+        changed so its version is bumped and checked when it is flushed.
+
+        Args:
+            data (list): A list of dictionaries containing the Item data,
+                with the id of the Item they replace when there is one
+        """
+        if not isinstance(data, list):
+            raise DataValidationError("Invalid order: items must be a list")
+        wanted = []
+        for entry in data:
+            item = Item().deserialize(entry)
+            wanted.append({
+                "id": entry.get("id"),
+                "product_id": item.product_id,
+                "quantity": item.quantity,
+                "total": item.total,
+            })
+        items = Item.__table__
+        current = db.session.execute(
+            select(items.c.id, items.c.product_id, items.c.quantity, items.c.total)
+            .where(items.c.order_id == self.id)
+        ).all()
+        inserts, updates, deletes = plan_items(current, wanted)
+        logger.info(
+            "Replacing the items of order %s: %s new, %s changed, %s removed",
+            self.id, len(inserts), len(updates), len(deletes),
+        )
+        Item.write_plan(self.id, inserts, updates, deletes)
+        self.item_count = len(wanted)
+        self.items_total = sum(item["total"] for item in wanted)
+        if inserts or updates or deletes:
+            flag_modified(self, "items_total")
+        db.session.expire(self, ["items"])
+        return self
+
+    @classmethod
+    def parse_changes(cls, data) -> dict:
+        """Returns the columns a partial update of an Order sets, see BaseModel.parse_changes()"""
+        if isinstance(data, dict) and isinstance(data.get("date"), str):
+            try:
+                data = {**data, "date": date.fromisoformat(data["date"])}
+            except ValueError as error:
+                raise DataValidationError("Invalid order: " + str(error)) from error
+        return super().parse_changes(data)
+
     @classmethod
-    def find_by_status(cls, status):
+    def patch(cls, by_id, changes, version=None):
+        """
+        Changes some fields of an Order with a single UPDATE
+
+        Only the changed columns and the version are written, and neither
+        the Order nor its Items are loaded. A new status is only written
+        while the current one may move to it, see TRANSITIONS, or is the same. The customer
+        summaries are recomputed when a field they count changed.
+
+        Args:
+            by_id: The id of the Order
+            changes (dict): The columns to set, see parse_changes()
+            version (int): Only change the Order while it is at this version
+
+        Returns:
+            The serialized Order without its Items, or None if there is no
+            Order with the id at the version and a status it can leave
+        """
+        logger.info("Patching order %s", by_id)
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        orders = cls.__table__
+        fields = [name for name in cls.FIELDS if name != "items"]
+        statement = update(orders).where(orders.c.id == by_id)
+        if version is not None:
+            statement = statement.where(orders.c.version == version)
+        if "status" in changes:
+            # resending the current status is not a transition
+            new = changes["status"]
+            statement = statement.where(
+                or_(orders.c.status == new, orders.c.status.in_(cls.TRANSITIONS[new]))
+            )
+        returning = [orders.c[name] for name in fields]
+        if "customer_id" in changes:
+            # the row as it was before the UPDATE, to refresh the old customer too
+            old = (
+                select(orders.c.id, orders.c.customer_id)
+                .where(orders.c.id == by_id)
+                .with_for_update()
+                .subquery("old")
+            )
+            statement = statement.where(orders.c.id == old.c.id)
+            returning.append(old.c.customer_id.label("old_customer_id"))
+        statement = statement.values(**changes, version=orders.c.version + 1).returning(*returning)
+        try:
+            row = db.session.execute(statement).first()
+            if row is not None and cls.SUMMARIZED.intersection(changes):
+                customer_ids = {row.customer_id, getattr(row, "old_customer_id", row.customer_id)}
+                CustomerSummary.refresh(db.session.connection(), customer_ids)
+            db.session.commit()
+        except (DataError, IntegrityError) as error:
+            db.session.rollback()
+            logger.error("Patch of order %s rejected by the database: %s", by_id, error.orig)
+            raise DataValidationError(
+                "Invalid order: the changes were rejected by the database"
+            ) from error
+        if row is None:
+            return None
+        cls.cache.delete(by_id)
+        data = {name: getattr(row, name) for name in fields}
+        data["date"] = data["date"].isoformat()
+        return data
+
+    @classmethod
+    def base_query(cls, with_items=True):
+        """
+        Returns a query of Orders
+
+        When with_items is set the Items of every Order in the result are
+        loaded together in a batched SELECT ... WHERE order_id IN (...)
+        instead of one lazy SELECT per Order on serialize().
+        """
+        if with_items:
+            return cls.query.options(selectinload(cls.items))
+        return cls.query
+
+    @classmethod
+    def all(cls, with_items=True):
+        """ Returns all of the Orders in the database """
+        logger.info("Processing all Orders")
+        return cls.base_query(with_items).all()
+
+    @classmethod
+    def find_by_status(cls, status, with_items=True):
         """Returns all Orders with the given status """
         logger.info("Processing status query for %s ...", status)
-        return cls.query.filter(cls.status == status)
+        return cls.base_query(with_items).filter(cls.status == status)
 
     @classmethod
-    def find_by_customer_id(cls, customer_id):
+    def find_by_customer_id(cls, customer_id, with_items=True):
         """Returns all Orders with the given customer id"""
         logger.info("Processing customer id query for %s ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id)
+        return cls.base_query(with_items).filter(cls.customer_id == customer_id)
 
     @classmethod
-    def find_by_customer_id_and_status(cls, customer_id, status):
+    def find_by_customer_id_and_status(cls, customer_id, status, with_items=True):
         """
         Find and return all orders for a given customer id and a specific order status.
 
         Args:
             customer_id: The id of the customer.
             status: The status of the orders to return.
+            with_items: Batch load the items of the orders.
 
         Returns:
-            A list of orders that match the provided customer id and status.
+            A query of orders that match the provided customer id and status.
         """
         logger.info("Processing customer-id and status query for %s and %s", customer_id, status)
-        return cls.query.filter(cls.customer_id == customer_id, cls.status == status).all()
+        query = cls.base_query(with_items)
+        return query.filter(cls.customer_id == customer_id, cls.status == status)
+
+    @classmethod
+    def find_serialized(cls, by_id, fields=None):
+        """
+        Returns the serialized Order with the given id, reading through the cache
+
+        Only whole Orders are cached. A request for some of the fields is
+        answered from a cached Order when there is one, and otherwise with
+        a query narrowed to those fields that is not cached.
+
+        Returns:
+            The serialized Order, or None if there is no Order with the id
+        """
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        data, stamp = cls.cache.lookup(by_id)
+        if data is not None:
+            return {name: data[name] for name in fields} if fields else data
+
+        if fields:
+            order = cls.find(by_id, fields)
+        else:
+            order = cls.find_with_items(by_id)
+        if not order:
+            return None
+        data = order.serialize(fields)
+        if not fields:
+            cls.cache.set(by_id, data, stamp)
+        return data
+
+    @classmethod
+    def find_version(cls, by_id):
+        """
+        Returns the version of an Order, None if there is no Order with the id
+
+        The version is read from the cached Order when there is one, and
+        otherwise with a query of that column alone.
+        """
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        data, _ = cls.cache.lookup(by_id)
+        if data is not None:
+            return data["version"]
+        return db.session.execute(select(cls.version).where(cls.id == by_id)).scalar()
+
+    @classmethod
+    def find_with_items(cls, by_id):
+        """Finds an Order by it's ID together with its Items, through the negative cache"""
+        missing, stamp = cls.missing.lookup(cls.missing_key(by_id))
+        if missing:
+            return None
+        order = cls.base_query().filter(cls.id == by_id).first()
+        if order is None:
+            cls.remember_missing(by_id, stamp)
+        return order
+
+    @classmethod
+    def transition(cls, status, ids=None, customer_id=None, from_status=None):
+        """
+        Moves many Orders to a new status in a single guarded UPDATE
+
+        Only Orders whose current status is an allowed predecessor of the
+        new one in TRANSITIONS are changed, so the rules are enforced by
+        the WHERE clause instead of loading each Order.
+
+        Args:
+            status: The status to move the Orders to.
+            ids: Only move the Orders with these ids.
+            customer_id: Only move the Orders of this customer.
+            from_status: Only move the Orders currently in this status.
+
+        Returns:
+            The ids of the Orders that were changed.
+        """
+        logger.info("Processing transition of orders to %s ...", status)
+        if not cls.TRANSITIONS.get(status):
+            raise DataValidationError(f"Invalid transition: orders cannot move to {status}")
+        if from_status is not None and from_status not in cls.TRANSITIONS:
+            raise DataValidationError(f"Invalid transition: unknown status {from_status}")
+
+        criteria = [cls.status.in_(cls.TRANSITIONS[status])]
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(by_id, int) for by_id in ids):
+                raise DataValidationError("Invalid transition: ids must be a list of integers")
+            criteria.append(cls.id.in_(ids))
+        if customer_id is not None:
+            criteria.append(cls.customer_id == customer_id)
+        if from_status is not None:
+            criteria.append(cls.status == from_status)
+        if len(criteria) == 1:
+            raise DataValidationError("Invalid transition: ids or a filter is required")
+
+        statement = update(cls).where(*criteria).values(status=status, version=cls.version + 1)
+        rows = db.session.execute(
+            statement.returning(cls.id, cls.customer_id),
+            execution_options={"synchronize_session": False},
+        ).all()
+        CustomerSummary.refresh(db.session.connection(), {row.customer_id for row in rows})
+        db.session.commit()
+        changed = [row.id for row in rows]
+        for order_id in changed:
+            cls.cache.delete(order_id)
+        return changed
+
+    @classmethod
+    def stats(cls, query, group_by=None, bucket="day"):
+        """
+        Returns aggregate statistics of Order totals computed in the database
+
+        Args:
+            query: The query of orders to aggregate.
+            group_by: The field to group by (status, payment, customer_id or date).
+            bucket: The date_trunc precision used when grouping by date.
+
+        Returns:
+            A list of dicts with the group and the count, sum, average, min
+            and max of the totals in it.
+        """
+        logger.info("Processing order stats grouped by %s ...", group_by)
+        # pylint: disable=not-callable
+        aggregates = [
+            func.count(cls.id).label("count"),
+            func.sum(cls.total).label("sum"),
+            func.avg(cls.total).label("average"),
+            func.min(cls.total).label("min"),
+            func.max(cls.total).label("max"),
+        ]
+        if not group_by:
+            return [{"group": None, **query.with_entities(*aggregates).one()._asdict()}]
+        if group_by == "date":
+            key = func.date_trunc(bucket, cls.date).cast(db.Date)
+        else:
+            key = getattr(cls, group_by)
+        query = query.with_entities(key.label("group"), *aggregates).group_by(key).order_by(key)
+        return [row._asdict() for row in query]
+
+    @classmethod
+    def add_items(cls, connection, order_id, count, total):
+        """Adds to the item counters of an Order and returns their new values"""
+        statement = (
+            update(cls)
+            .where(cls.id == order_id)
+            .values(
+                item_count=cls.item_count + count,
+                items_total=cls.items_total + total,
+                version=cls.version + 1,
+            )
+            .returning(cls.item_count, cls.items_total, cls.version)
+        )
+        return connection.execute(statement).first()
+
+    @classmethod
+    def rebuild_item_counters(cls):
+        """Recomputes the item counters of every Order from its Items in one UPDATE"""
+        logger.info("Rebuilding the item counters of all orders")
+        # pylint: disable=not-callable
+        items = select(Item.order_id).where(Item.order_id == cls.id)
+        statement = update(cls).values(
+            item_count=items.with_only_columns(func.count(Item.id)).scalar_subquery(),
+            items_total=items.with_only_columns(
+                func.coalesce(func.sum(Item.total), 0.0)
+            ).scalar_subquery(),
+            version=cls.version + 1,
+        )
+        rows = db.session.execute(statement).rowcount
+        db.session.commit()
+        cls.cache.clear()
+        return rows
+
+
+##################################################
+# CUSTOMER SUMMARY MODEL
+##################################################
+class CustomerSummary(db.Model):
+    """
+    A Class that represent the Orders of a customer in one row
+
+    The row is kept in step with the Orders of the customer in the same
+    transaction that changes them, see update_customer_summaries().
+    """
+    customer_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    open_count = db.Column(db.Integer, nullable=False, default=0)
+    shipping_count = db.Column(db.Integer, nullable=False, default=0)
+    delivered_count = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    last_order_date = db.Column(db.Date(), nullable=True)
+
+    # The count column of each Order status
+    STATUS_COUNTS = {
+        "OPEN": "open_count",
+        "SHIPPING": "shipping_count",
+        "DELIVERED": "delivered_count",
+        "CANCELLED": "cancelled_count",
+    }
+    COUNTERS = ("order_count", *STATUS_COUNTS.values(), "total")
+
+    def __repr__(self):
+        return f"<CustomerSummary customer_id=[{self.customer_id}]>"
+
+    def serialize(self) -> dict:
+        """Serialize a CustomerSummary into a dict"""
+        return {
+            "customer_id": self.customer_id,
+            "order_count": self.order_count,
+            "status_counts": {
+                status: getattr(self, column) for status, column in self.STATUS_COUNTS.items()
+            },
+            "total": self.total,
+            "last_order_date": self.last_order_date.isoformat() if self.last_order_date else None,
+        }
+
+    @classmethod
+    def find(cls, customer_id):
+        """Returns the summary of a customer, empty if the customer has no Orders"""
+        logger.info("Processing summary lookup for customer %s ...", customer_id)
+        summary = db.session.get(cls, customer_id)
+        if summary is None:
+            summary = cls(customer_id=customer_id, last_order_date=None)
+            for counter in cls.COUNTERS:
+                setattr(summary, counter, 0)
+        return summary
+
+    @classmethod
+    def apply(cls, connection, deltas):
+        """Adds the deltas of each customer to their summary with one upsert"""
+        statement = pg_insert(cls)
+        changes = {
+            counter: getattr(cls, counter) + statement.excluded[counter] for counter in cls.COUNTERS
+        }
+        changes["last_order_date"] = func.greatest(
+            cls.last_order_date, statement.excluded.last_order_date
+        )
+        statement = statement.on_conflict_do_update(index_elements=[cls.customer_id], set_=changes)
+        connection.execute(statement, list(deltas.values()))
+
+    @classmethod
+    def refresh(cls, connection, customer_ids=None):
+        """
+        Recomputes the summaries of the given customers, or of all of them, from their Orders
+
+        The summaries are written with an upsert, so two transactions that
+        refresh the same customer at once wait for each other instead of both
+        inserting its row, and the ones of customers left without Orders are
+        deleted.
+        """
+        # pylint: disable=not-callable
+        totals = [
+            Order.customer_id,
+            func.count(Order.id),
+            *[func.count(Order.id).filter(Order.status == status) for status in cls.STATUS_COUNTS],
+            func.sum(Order.total),
+            func.max(Order.date),
+        ]
+        query = select(*totals).group_by(Order.customer_id)
+        clear = delete(cls).where(~exists().where(Order.customer_id == cls.customer_id))
+        if customer_ids is not None:
+            if not customer_ids:
+                return
+            query = query.where(Order.customer_id.in_(customer_ids))
+            clear = clear.where(cls.customer_id.in_(customer_ids))
+        columns = [
+            "customer_id", "order_count", *cls.STATUS_COUNTS.values(), "total", "last_order_date"
+        ]
+        statement = pg_insert(cls).from_select(columns, query)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.customer_id],
+            set_={name: statement.excluded[name] for name in columns[1:]},
+        )
+        connection.execute(statement)
+        connection.execute(clear)
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuilds every summary from the Orders"""
+        logger.info("Rebuilding all customer summaries")
+        cls.refresh(db.session.connection())
+        db.session.commit()
+
+
+##################################################
+# IDEMPOTENCY KEY MODEL
+##################################################
+class IdempotencyKey(db.Model):
+    """
+    A Class that represent the response to a request sent with an Idempotency-Key
+
+    A key is claimed before its request runs and holds no response until the
+    request succeeds, so a retry arriving meanwhile sees it is in progress.
+    The claim is a short lease, so the key of a request whose worker died
+    is free again once the lease is over, and only a stored response is
+    kept for the full TTL. Expired keys are reused by the next claim and
+    removed by purge().
+    """
+    __tablename__ = "idempotency_key"
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    location = db.Column(db.String(255), nullable=True)
+    expires = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} status=[{self.status}]>"
+
+    @classmethod
+    def claim(cls, key, fingerprint, lease):
+        """
+        Claims a key for a request with one upsert
+
+        Args:
+            lease: Seconds the key stays claimed if the request never ends
+
+        Returns:
+            None if the key is now claimed for this request, otherwise the
+            key as stored by the request that claimed it first
+        """
+        logger.info("Claiming idempotency key %s", key)
+        # pylint: disable=not-callable
+        statement = pg_insert(cls).values(
+            key=key, fingerprint=fingerprint, expires=func.now() + timedelta(seconds=lease)
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.key],
+            set_={
+                "fingerprint": statement.excluded.fingerprint,
+                "status": None,
+                "body": None,
+                "location": None,
+                "expires": statement.excluded.expires,
+            },
+            where=cls.expires < func.now(),
+        ).returning(cls.key)
+        claimed = db.session.execute(statement).first()
+        db.session.commit()
+        if claimed:
+            return None
+        return db.session.execute(
+            select(cls).where(cls.key == key).execution_options(populate_existing=True)
+        ).scalar_one_or_none()
+
+    @classmethod
+    def complete(cls, key, status, body, location=None, ttl=86400):  # pylint: disable=too-many-arguments
+        """Stores the response to the request that claimed a key, for ttl seconds"""
+        logger.info("Storing the response of idempotency key %s", key)
+        # pylint: disable=not-callable
+        db.session.execute(
+            update(cls).where(cls.key == key).values(
+                status=status, body=body, location=location,
+                expires=func.now() + timedelta(seconds=ttl),
+            )
+        )
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key):
+        """Gives a key up when its request failed so that it can be retried"""
+        logger.info("Releasing idempotency key %s", key)
+        db.session.rollback()
+        db.session.execute(delete(cls).where(cls.key == key, cls.status.is_(None)))
+        db.session.commit()
+
+    @classmethod
+    def purge(cls):
+        """Deletes the expired keys and returns how many there were"""
+        logger.info("Purging expired idempotency keys")
+        # pylint: disable=not-callable
+        result = db.session.execute(delete(cls).where(cls.expires < func.now()))
+        db.session.commit()
+        return result.rowcount
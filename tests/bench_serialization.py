@@ -0,0 +1,60 @@
+"""
+Benchmark of the Order serialization paths
+
+Compares the marshalling path (Order.serialize(), marshal() and
+json.dumps()) with the compiled serializer, with orjson and with the
+standard library json module, for 1, 100 and 10,000 Orders of 3 Items.
+
+Usage:
+    python -m tests.bench_serialization
+"""
+import json
+import timeit
+from datetime import date
+from unittest.mock import patch
+from flask_restx import marshal
+from service.common import serializer
+from service.routes import order_model, order_serializer
+from tests.factories import ItemFactory, OrderFactory
+
+SIZES = (1, 100, 10000)
+
+
+def make_orders(count):
+    """Builds Orders with Items in memory, the database is not used"""
+    orders = []
+    for _ in range(count):
+        order = OrderFactory(date=date(2023, 7, 1))
+        order.items = [ItemFactory(order=order) for _ in range(3)]
+        orders.append(order)
+    return orders
+
+
+def marshalled(orders):
+    """The response body as built before the compiled serializer"""
+    return json.dumps(marshal([order.serialize() for order in orders], order_model)).encode("utf-8")
+
+
+def best_of(function, orders):
+    """Returns the best time of a serialization in milliseconds"""
+    number = max(1, 1000 // len(orders))
+    return min(timeit.repeat(lambda: function(orders), number=number, repeat=5)) / number * 1000
+
+
+def main():
+    """Prints the time of each serialization path for each number of Orders"""
+    print(f"{'orders':>8} {'marshal ms':>12} {'compiled ms':>12} {'+orjson ms':>12} {'speedup':>8}")
+    for size in SIZES:
+        orders = make_orders(size)
+        assert json.loads(marshalled(orders)) == json.loads(order_serializer.dumps(orders))
+        baseline = best_of(marshalled, orders)
+        with patch.object(serializer, "orjson", None):
+            compiled = best_of(order_serializer.dumps, orders)
+        fastest = best_of(order_serializer.dumps, orders) if serializer.orjson else compiled
+        print(
+            f"{size:>8} {baseline:>12.3f} {compiled:>12.3f} {fastest:>12.3f} {baseline / fastest:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Test cases for the Cache Backends
+"""
+import os
+import time
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from service.common.cache import LRUCache, NullCache, RedisCache, SQLiteCache, make_cache
+
+
+class FakeRedis:
+    """An in-memory stand-in for the redis client, with the commands RedisCache sends"""
+
+    def __init__(self):
+        self.values = {}
+
+    def _live(self, key):
+        value, expires = self.values.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            del self.values[key]
+            return None
+        return value
+
+    def mget(self, keys):
+        """ Returns the values of keys, None for the missing ones """
+        return [self._live(key) for key in keys]
+
+    def set(self, key, value, px=None):
+        """ Stores a value that expires px milliseconds later """
+        self.values[key] = (value, None if px is None else time.time() + px / 1000)
+
+    def incr(self, key):
+        """ Increments a counter, keeping its expiry """
+        value = int(self._live(key) or 0) + 1
+        self.values[key] = (str(value).encode(), self.values.get(key, (None, None))[1])
+        return value
+
+    def pexpire(self, key, milliseconds):
+        """ Sets the expiry of a key """
+        self.values[key] = (self.values[key][0], time.time() + milliseconds / 1000)
+        return True
+
+    def pipeline(self):
+        """ Returns a pipeline that runs its commands on execute() """
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """A pipeline of the FakeRedis client"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+    def incr(self, key):
+        """ Queues an increment """
+        self.commands.append((self.client.incr, key))
+
+    def pexpire(self, key, milliseconds):
+        """ Queues an expiry """
+        self.commands.append((self.client.pexpire, key, milliseconds))
+
+    def execute(self):
+        """ Runs the queued commands """
+        return [command(*args) for command, *args in self.commands]
+
+
+class TestCache(TestCase):
+    """Test Cases for the Cache Backends"""
+
+    def test_lru_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"id": 1})
+        self.assertEqual(cache.get(1), {"id": 1})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_lru_size_bound(self):
+        """It should evict the least recently used value when full"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "one")
+        self.assertEqual(cache.size(), 2)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+    def test_lru_ttl(self):
+        """It should expire values after the TTL"""
+        cache = LRUCache(maxsize=2, ttl=10)
+        with patch("service.common.cache.time.monotonic", return_value=100.0):
+            cache.set(1, "one")
+        with patch("service.common.cache.time.monotonic", return_value=105.0):
+            self.assertEqual(cache.get(1), "one")
+        with patch("service.common.cache.time.monotonic", return_value=110.0):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.size(), 0)
+
+    def test_lru_stale_set_after_delete(self):
+        """It should not cache a value read before a key was deleted"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        value, stamp = cache.lookup(1)
+        self.assertIsNone(value)
+        cache.delete(1)
+        cache.set(1, "stale", stamp)
+        self.assertIsNone(cache.get(1))
+        _, stamp = cache.lookup(1)
+        cache.set(1, "fresh", stamp)
+        self.assertEqual(cache.get(1), "fresh")
+
+    def test_null_cache(self):
+        """It should never return a value from the null cache"""
+        cache = NullCache()
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+        cache.delete(1)
+        cache.clear()
+        self.assertEqual(cache.stats(), {"backend": "null", "hits": 0, "misses": 1, "size": 0})
+
+    def test_make_cache(self):
+        """It should make the cache backend named in the config"""
+        cache = make_cache({"CACHE_BACKEND": "memory", "CACHE_MAXSIZE": 5, "CACHE_TTL": 1.0})
+        self.assertIsInstance(cache, LRUCache)
+        self.assertEqual(cache.maxsize, 5)
+        self.assertIsInstance(make_cache({"CACHE_BACKEND": "null"}), NullCache)
+        self.assertRaises(ValueError, make_cache, {"CACHE_BACKEND": "bogus"})
+        with patch("service.common.cache.redis", None):
+            self.assertRaises(ValueError, make_cache, {"CACHE_BACKEND": "redis", "CACHE_URL": "redis://"})
+
+
+class TestSharedCache(TestCase):
+    """Test Cases for the Shared Cache Backends"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        # two workers sharing one file
+        self.first = SQLiteCache(self.path, ttl=60)
+        self.second = SQLiteCache(self.path, ttl=60)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_shared_between_workers(self):
+        """It should serve a value cached by one worker to the others"""
+        self.first.set(1, {"id": 1, "items": [{"id": 2}]})
+        self.assertEqual(self.second.get(1), {"id": 1, "items": [{"id": 2}]})
+        self.assertEqual(self.second.stats()["hits"], 1)
+        self.assertEqual(self.first.size(), 1)
+
+    def test_delete_from_any_worker(self):
+        """It should hide a value from every worker once one of them deletes it"""
+        self.first.set(1, "old")
+        self.second.delete(1)
+        self.assertIsNone(self.first.get(1))
+        self.assertIsNone(self.second.get(1))
+
+    def test_stale_set_after_delete(self):
+        """It should not serve a value read before the key was invalidated"""
+        value, stamp = self.first.lookup(1)
+        self.assertIsNone(value)
+        self.second.delete(1)
+        self.first.set(1, "stale", stamp)
+        self.assertIsNone(self.second.get(1))
+        _, stamp = self.second.lookup(1)
+        self.second.set(1, "fresh", stamp)
+        self.assertEqual(self.first.get(1), "fresh")
+
+    def test_clear(self):
+        """It should drop every value of every worker on clear"""
+        self.first.set(1, "one")
+        self.first.set(2, "two")
+        self.second.clear()
+        self.assertIsNone(self.first.get(1))
+        self.assertIsNone(self.first.get(2))
+
+    def test_ttl(self):
+        """It should expire shared values after the TTL"""
+        with patch("service.common.cache.time.time", return_value=1000.0):
+            self.first.set(1, "one")
+        with patch("service.common.cache.time.time", return_value=1059.0):
+            self.assertEqual(self.second.get(1), "one")
+        with patch("service.common.cache.time.time", return_value=1060.0):
+            self.assertIsNone(self.second.get(1))
+
+    def test_purge_expired(self):
+        """It should delete the expired rows once every TTL"""
+        with patch("service.common.cache.time.time", return_value=1000.0):
+            cache = SQLiteCache(self.path, ttl=60)
+            cache.set(1, "one")
+            cache.delete(2)
+            cache.clear()
+        count = "SELECT count(*) FROM cache"
+        self.assertEqual(cache._connection().execute(count).fetchone()[0], 3)  # pylint: disable=protected-access
+        with patch("service.common.cache.time.time", return_value=1059.0):
+            cache.set(3, "three")
+        self.assertEqual(cache._connection().execute(count).fetchone()[0], 4)  # pylint: disable=protected-access
+        with patch("service.common.cache.time.time", return_value=1601.0):
+            cache.set(4, "four")
+            self.assertEqual(cache.get(4), "four")
+        # the versions and the generation expire too, after ten times the TTL
+        self.assertEqual(cache._connection().execute(count).fetchone()[0], 1)  # pylint: disable=protected-access
+
+    def test_make_shared_cache(self):
+        """It should make the shared cache backends named in the config"""
+        cache = make_cache({"CACHE_BACKEND": "sqlite", "CACHE_URL": self.path, "CACHE_TTL": 5.0})
+        self.assertIsInstance(cache, SQLiteCache)
+        self.assertEqual(cache.stats()["ttl"], 5.0)
+        with patch("service.common.cache.redis") as redis_mock:
+            cache = make_cache({"CACHE_BACKEND": "redis", "CACHE_URL": "redis://cache:6379/0"})
+        self.assertIsInstance(cache, RedisCache)
+        redis_mock.Redis.from_url.assert_called_once_with("redis://cache:6379/0")
+
+    def test_redis_commands(self):
+        """It should version the keys it sends to redis"""
+        with patch("service.common.cache.redis") as redis_mock:
+            cache = RedisCache("redis://cache", ttl=2, prefix="test")
+        client = redis_mock.Redis.from_url.return_value
+        client.mget.side_effect = [[b"3", b"7"], [None]]
+        self.assertEqual(cache.lookup(1), (None, "3:7"))
+        client.mget.assert_called_with(["test:3:7:1"])
+        cache.set(1, {"id": 1}, "3:7")
+        client.set.assert_called_once_with("test:3:7:1", b'{"id":1}', px=2000)
+        pipeline = MagicMock()
+        client.pipeline.return_value.__enter__.return_value = pipeline
+        cache.delete(1)
+        pipeline.incr.assert_called_once_with("test:version:1")
+        pipeline.pexpire.assert_called_once_with("test:version:1", 20000)
+
+
+class TestRedisCache(TestCase):
+    """Test Cases for the Redis Cache Backend, on a fake client"""
+
+    def setUp(self):
+        client = FakeRedis()
+        with patch("service.common.cache.redis") as redis_mock:
+            redis_mock.Redis.from_url.return_value = client
+            # two workers sharing one server
+            self.first = RedisCache("redis://cache", ttl=60)
+            self.second = RedisCache("redis://cache", ttl=60)
+
+    def test_shared_between_workers(self):
+        """It should serve a value cached by one worker to the others"""
+        self.first.set(1, {"id": 1, "items": [{"id": 2}]})
+        self.assertEqual(self.second.get(1), {"id": 1, "items": [{"id": 2}]})
+        self.assertEqual(self.second.stats()["hits"], 1)
+        self.assertIsNone(self.second.size())
+
+    def test_delete_and_clear(self):
+        """It should hide values from every worker once one of them deletes or clears them"""
+        self.first.set(1, "one")
+        self.first.set(2, "two")
+        self.second.delete_many([1])
+        self.assertIsNone(self.first.get(1))
+        self.assertEqual(self.first.get(2), "two")
+        self.second.clear()
+        self.assertIsNone(self.first.get(2))
+
+    def test_stale_set_after_delete(self):
+        """It should not serve a value read before the key was invalidated"""
+        value, stamp = self.first.lookup(1)
+        self.assertIsNone(value)
+        self.second.delete(1)
+        self.first.set(1, "stale", stamp)
+        self.assertIsNone(self.second.get(1))
+
+    def test_ttl(self):
+        """It should expire the values after the TTL, and the versions later"""
+        with patch("time.time", return_value=1000.0):
+            self.first.set(1, "one")
+            self.first.delete(2)
+            self.first.set(2, "two")
+        with patch("time.time", return_value=1059.0):
+            self.assertEqual(self.second.get(1), "one")
+            self.assertEqual(self.second.get(2), "two")
+        with patch("time.time", return_value=1060.0):
+            self.assertIsNone(self.second.get(1))
+            self.assertEqual(self.second.lookup(2)[1], "0:1")
+        with patch("time.time", return_value=1600.0):
+            self.assertEqual(self.second.lookup(2)[1], "0:0")
@@ -5,7 +5,11 @@ import os
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from sqlalchemy import event, inspect, text
+from service.models import db
+from service.common.cli_commands import (
+    db_create, db_indexes, db_item_counters, db_summaries, db_idempotency_purge, db_order_version
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +25,84 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.db')
+    def test_db_indexes(self, db_mock):
+        """It should call the db-indexes command"""
+        index = MagicMock(dialect_kwargs={})
+        table = MagicMock()
+        table.to_metadata.return_value.indexes = {index}
+        db_mock.metadata.sorted_tables = [table]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_indexes)
+            self.assertEqual(result.exit_code, 0)
+        connection = db_mock.engine.connect.return_value.__enter__.return_value.execution_options.return_value
+        statements = [str(call.args[0]) for call in connection.execute.call_args_list]
+        self.assertEqual(statements, ["SET statement_timeout = 0", "RESET statement_timeout"])
+        self.assertEqual(index.dialect_kwargs, {"postgresql_concurrently": True})
+        index.create.assert_called_once_with(bind=connection, checkfirst=True)
+        db_mock.drop_all.assert_not_called()
+
+    def test_db_indexes_concurrently(self):
+        """It should build a missing index concurrently, outside of a transaction"""
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX IF EXISTS ix_order_date_id"))
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_execute)
+        try:
+            with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+                result = self.runner.invoke(db_indexes)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_execute)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("CREATE INDEX CONCURRENTLY ix_order_date_id ON \"order\" (date, id)", statements)
+        self.assertIn("ix_order_date_id", {index["name"] for index in inspect(db.engine).get_indexes("order")})
+
+    @patch('service.common.cli_commands.Order.rebuild_item_counters', return_value=3)
+    @patch('service.common.cli_commands.db.session')
+    def test_db_item_counters(self, session_mock, rebuild_mock):
+        """It should call the db-item-counters command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_item_counters)
+            self.assertEqual(result.exit_code, 0)
+        statements = [str(call.args[0]) for call in session_mock.execute.call_args_list]
+        self.assertEqual(statements[0], "SET LOCAL statement_timeout = 0")
+        self.assertTrue(all(statement.startswith('ALTER TABLE "order" ADD COLUMN IF NOT EXISTS')
+                            for statement in statements[1:3]))
+        self.assertEqual(statements[3:], ["SET LOCAL statement_timeout = 0"])
+        rebuild_mock.assert_called_once_with()
+
+    @patch('service.common.cli_commands.CustomerSummary')
+    @patch('service.common.cli_commands.db.session')
+    def test_db_summaries(self, session_mock, summary_mock):
+        """It should call the db-summaries command without a statement timeout"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_summaries)
+            self.assertEqual(result.exit_code, 0)
+        self.assertEqual(str(session_mock.execute.call_args.args[0]), "SET LOCAL statement_timeout = 0")
+        summary_mock.rebuild.assert_called_once_with()
+
+    @patch('service.common.cli_commands.IdempotencyKey')
+    @patch('service.common.cli_commands.db.session')
+    def test_db_idempotency_purge(self, session_mock, key_mock):
+        """It should call the db-idempotency-purge command"""
+        key_mock.purge.return_value = 2
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_idempotency_purge)
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("2 expired idempotency keys deleted", result.output)
+        self.assertEqual(str(session_mock.execute.call_args.args[0]), "SET LOCAL statement_timeout = 0")
+
+    @patch('service.common.cli_commands.db.session')
+    def test_db_order_version(self, session_mock):
+        """It should call the db-order-version command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_order_version)
+            self.assertEqual(result.exit_code, 0)
+        statement = str(session_mock.execute.call_args.args[0])
+        self.assertTrue(statement.startswith('ALTER TABLE "order" ADD COLUMN IF NOT EXISTS version'))
+        session_mock.commit.assert_called_once_with()
@@ -0,0 +1,101 @@
+"""
+Test cases for Response Compression
+"""
+import gzip
+import json
+from unittest import TestCase
+from flask import Flask, Response
+from service.common.compression import Compressor, GzipEncoder, init_compression
+
+NDJSON = "application/x-ndjson"
+
+
+class TestCompression(TestCase):
+    """Test Cases for Response Compression"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.compressor = Compressor(["zstd", "br", "gzip"], 6, 100, ("application/json", NDJSON))
+        self.app.after_request(self.compressor)
+
+        @self.app.route("/big")
+        def big():
+            return [{"status": "DELIVERED", "id": index} for index in range(100)]
+
+        @self.app.route("/small")
+        def small():
+            return {"status": "OPEN"}
+
+        @self.app.route("/stream")
+        def stream():
+            lines = (json.dumps({"id": index}) + "\n" for index in range(50))
+            return Response(lines, mimetype=NDJSON)
+
+        self.client = self.app.test_client()
+
+    def test_gzip_large_response(self):
+        """It should gzip a large JSON response when the client accepts it"""
+        resp = self.client.get("/big", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        data = json.loads(gzip.decompress(resp.data))
+        self.assertEqual(len(data), 100)
+        stats = self.compressor.stats()["gzip"]
+        self.assertEqual(stats["responses"], 1)
+        self.assertEqual(stats["bytes_out"], int(resp.headers["Content-Length"]))
+        self.assertGreater(stats["ratio"], 5)
+
+    def test_small_response(self):
+        """It should not compress a response under the size threshold"""
+        resp = self.client.get("/small", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_json(), {"status": "OPEN"})
+
+    def test_not_accepted(self):
+        """It should not compress when the client does not accept an encoding"""
+        resp = self.client.get("/big")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp = self.client.get("/big", headers={"Accept-Encoding": "gzip;q=0, identity"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(len(resp.get_json()), 100)
+
+    def test_stream(self):
+        """It should compress a streamed response chunk by chunk"""
+        resp = self.client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", resp.headers)
+        lines = gzip.decompress(resp.data).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], list(range(50)))
+        self.assertEqual(self.compressor.stats()["gzip"]["bytes_out"], len(resp.data))
+
+    def test_gzip_stream_flushes(self):
+        """It should emit every chunk of a stream as soon as it is compressed"""
+        blocks = GzipEncoder(6).stream(iter([b"first\n", b"second\n"]))
+        decoder = gzip.zlib.decompressobj(16 + gzip.zlib.MAX_WBITS)
+        self.assertEqual(decoder.decompress(next(blocks)), b"first\n")
+        self.assertEqual(decoder.decompress(next(blocks)), b"second\n")
+
+    def test_weak_etag(self):
+        """It should weaken a strong ETag of a compressed response"""
+        @self.app.route("/tagged")
+        def tagged():
+            return [{"status": "DELIVERED"}] * 100, 200, {"ETag": '"abc"'}
+
+        resp = self.client.get("/tagged", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["ETag"], 'W/"abc"')
+
+    def test_unknown_algorithms(self):
+        """It should skip encodings that are not available"""
+        compressor = Compressor(["lzma", "gzip"])
+        self.assertEqual(compressor.stats()["algorithms"], ["gzip"])
+
+    def test_init_compression_warns(self):
+        """It should warn about the configured encodings that are not available"""
+        self.app.config.update(
+            COMPRESS_ALGORITHMS="lzma, gzip", COMPRESS_LEVEL=6, COMPRESS_MIN_SIZE=100,
+            COMPRESS_MIMETYPES=("application/json",),
+        )
+        with self.assertLogs(self.app.logger, "WARNING") as logs:
+            compressor = init_compression(self.app)
+        self.assertEqual(compressor.stats()["algorithms"], ["gzip"])
+        self.assertIn("lzma is not available", logs.output[0])
@@ -0,0 +1,114 @@
+"""
+Test cases for the Group Commit
+"""
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from service import app
+from service.common.group_commit import GroupCommit, init_group_commit
+from service.models import db, Order, CustomerSummary, DataValidationError
+from tests.factories import OrderFactory
+
+
+class TestGroupCommit(TestCase):
+    """Test Cases for the Group Commit"""
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        db.session.query(Order).delete()
+        db.session.query(CustomerSummary).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def submit_together(self, committer, works):
+        """Submits each work from a thread of its own and returns their outcomes"""
+        outcomes = [None] * len(works)
+
+        def run(index, work):
+            with app.app_context():
+                try:
+                    outcomes[index] = committer.submit(work)
+                except Exception as error:  # pylint: disable=broad-except
+                    outcomes[index] = error
+                db.session.remove()
+
+        threads = [threading.Thread(target=run, args=pair) for pair in enumerate(works)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_one_commit_per_batch(self):
+        """It should save the writes arriving together with a single commit"""
+        committer = GroupCommit(window=5, max_batch=4)
+        orders = [OrderFactory() for _ in range(4)]
+        commits = []
+        count_commit = commits.append
+        event.listen(db.engine, "commit", count_commit)
+        try:
+            outcomes = self.submit_together(committer, [lambda order=order: order for order in orders])
+        finally:
+            event.remove(db.engine, "commit", count_commit)
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(sorted(data["customer_id"] for data in outcomes), sorted(o.customer_id for o in orders))
+        self.assertEqual(len(Order.all()), 4)
+        stats = committer.stats()
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["batch_sizes"], {4: 1})
+        self.assertEqual(stats["mean_batch"], 4)
+        self.assertLess(stats["max_wait_ms"], 5000)
+
+    def test_window(self):
+        """It should commit a lone write once the window is over"""
+        committer = GroupCommit(window=0.01, max_batch=10)
+        data = committer.submit(OrderFactory)
+        self.assertIsNotNone(Order.find(data["id"]))
+        stats = committer.stats()
+        self.assertEqual(stats["batch_sizes"], {1: 1})
+        self.assertGreaterEqual(stats["mean_wait_ms"], 10)
+
+    def test_write_fails(self):
+        """It should hand each write its own error and save the others"""
+        committer = GroupCommit(window=5, max_batch=3)
+
+        def invalid():
+            raise DataValidationError("bad order")
+
+        def too_long():
+            return OrderFactory(status="X" * 100)
+
+        outcomes = self.submit_together(committer, [OrderFactory, invalid, too_long])
+        errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        self.assertEqual(len(errors), 2)
+        self.assertIn(DataValidationError, [type(error) for error in errors])
+        saved = [outcome for outcome in outcomes if isinstance(outcome, dict)]
+        self.assertEqual([order.id for order in Order.all()], [saved[0]["id"]])
+        self.assertEqual(committer.stats()["errors"], 2)
+
+    def test_commit_fails(self):
+        """It should hand the commit error to every write of the batch"""
+        committer = GroupCommit(window=0, max_batch=1)
+        error = OperationalError("COMMIT", {}, Exception("down"))
+        with patch.object(type(db.session()), "commit", side_effect=error):
+            self.assertRaises(OperationalError, committer.submit, OrderFactory)
+        self.assertEqual(Order.all(), [])
+
+    def test_init_group_commit(self):
+        """It should only set up the group commit when it is enabled"""
+        with patch.dict(app.extensions), patch.dict(app.config, GROUP_COMMIT_ENABLED=False):
+            self.assertIsNone(init_group_commit(app))
+            self.assertNotIn("group_commit", app.extensions)
+        with patch.dict(app.extensions), patch.dict(app.config, GROUP_COMMIT_ENABLED=True):
+            committer = init_group_commit(app)
+            self.assertIs(app.extensions["group_commit"], committer)
+            self.assertEqual(committer.window, app.config["GROUP_COMMIT_WINDOW"])
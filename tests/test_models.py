@@ -4,9 +4,22 @@ Test cases for Order and OrderModel Model
 """
 # import os
 import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
+from collections import namedtuple
+from unittest.mock import patch
+from datetime import date
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 from service import app
-from service.models import Order, Item, DataValidationError, db
+from service.common.cache import LRUCache, NullCache, SQLiteCache
+from service.common.item_plan import plan_items
+from service.common.pagination import find_page
+from service.models import BaseModel, Order, Item, CustomerSummary, DataValidationError, IdempotencyKey, db
 from tests.factories import OrderFactory, ItemFactory
 
 
@@ -33,7 +46,11 @@ class TestOrder(unittest.TestCase):
         """ This runs before each test """
         db.session.query(Order).delete()  # clean up the last tests
         db.session.query(Item).delete()  # clean up the last tests
+        db.session.query(CustomerSummary).delete()
+        db.session.query(IdempotencyKey).delete()
         db.session.commit()
+        Order.cache.clear()
+        Order.missing.clear()
 
     def tearDown(self):
         """ This runs after each test """
@@ -47,6 +64,16 @@ class TestOrder(unittest.TestCase):
         """ It should always be true """
         self.assertTrue(True)
 
+    def test_engine_options(self):
+        """ It should tune the connection pool and session from the config """
+        options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        self.assertEqual(db.engine.pool.size(), options["pool_size"])
+        self.assertEqual(db.engine.pool.timeout(), options["pool_timeout"])
+        self.assertIn("statement_timeout", options["connect_args"]["options"])
+        timeout = db.session.execute(db.text("SHOW statement_timeout")).scalar()
+        self.assertNotEqual(timeout, "0")
+        self.assertEqual(db.session().expire_on_commit, app.config["SQLALCHEMY_EXPIRE_ON_COMMIT"])
+
     # ---------------------------------------------------------------------
     #               O R D E R  M E T H O D S
     # ---------------------------------------------------------------------
@@ -87,6 +114,22 @@ class TestOrder(unittest.TestCase):
         orders = Order.all()
         self.assertEqual(len(orders), 1)
 
+    def test_create_many_orders(self):
+        """It should Create many Orders in one transaction"""
+        orders = OrderFactory.build_batch(3)
+        Order.create_many(orders, chunk_size=2)
+        self.assertTrue(all(order.id is not None for order in orders))
+        self.assertEqual(len(Order.all()), 3)
+
+    def test_create_many_orders_rejected(self):
+        """It should not Create any Order when one is rejected by the database"""
+        orders = OrderFactory.build_batch(2)
+        orders[1].payment = "BITCOIN"
+        with self.assertRaises(DataValidationError) as context:
+            Order.create_many(orders)
+        self.assertNotIn("BITCOIN", str(context.exception))
+        self.assertEqual(len(Order.all()), 0)
+
     def test_read_an_order(self):
         """It should Read an Order"""
         order = OrderFactory()
@@ -193,6 +236,228 @@ class TestOrder(unittest.TestCase):
         self.assertEqual(same_order.customer_id, order.customer_id)
         self.assertEqual(same_order.status, order.status)
 
+    def test_find_with_items(self):
+        """It should batch load the items of the orders it finds"""
+        order = OrderFactory()
+        order.items.append(ItemFactory(id=None, order=None, order_id=None))
+        order.create()
+        db.session.expire_all()
+        same_order = Order.find_by_status(order.status)[0]
+        self.assertIn("items", same_order.__dict__)
+        self.assertEqual(len(same_order.items), 1)
+        db.session.expire_all()
+        same_order = Order.find_by_customer_id(order.customer_id, with_items=False)[0]
+        self.assertNotIn("items", same_order.__dict__)
+
+    def test_find_page(self):
+        """It should find a page of orders after a cursor"""
+        for _ in range(5):
+            OrderFactory().create()
+        orders, has_more = find_page(Order.query, 3)
+        self.assertEqual(len(orders), 3)
+        self.assertTrue(has_more)
+        keys = [(order.date, order.id) for order in orders]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+        rest, has_more = find_page(Order.query, 3, keys[-1])
+        self.assertEqual(len(rest), 2)
+        self.assertFalse(has_more)
+
+        back, has_more = find_page(Order.query, 3, (rest[0].date, rest[0].id), reverse=True)
+        self.assertEqual([order.id for order in back], [order.id for order in orders])
+        self.assertFalse(has_more)
+
+    def test_transition(self):
+        """It should move only the orders allowed to make a transition"""
+        shipping = OrderFactory(status="SHIPPING", customer_id=7)
+        shipping.create()
+        OrderFactory(status="OPEN", customer_id=7).create()
+        changed = Order.transition("DELIVERED", customer_id=7, from_status="SHIPPING")
+        self.assertEqual(changed, [shipping.id])
+        self.assertEqual(Order.find(shipping.id).status, "DELIVERED")
+        self.assertRaises(DataValidationError, Order.transition, "DELIVERED", from_status="LOST")
+
+    def test_version(self):
+        """It should bump the version of an order on every change to it or its items"""
+        order = OrderFactory(status="OPEN")
+        order.create()
+        self.assertEqual(order.version, 1)
+        order.address = "1 Main St"
+        order.update()
+        self.assertEqual(order.version, 2)
+        order.items.append(Item(product_id=1, quantity=1, total=2.0))
+        order.total = 3.0
+        order.update()
+        self.assertEqual(Order.find(order.id).version, 4)
+        self.assertTrue(Item(product_id=2, quantity=1, total=1.0).create_for_order(order.id))
+        Order.transition("CANCELLED", ids=[order.id])
+        self.assertEqual(Order.find(order.id).version, 6)
+
+    def test_version_conflict(self):
+        """It should not update an order changed since it was loaded"""
+        order = OrderFactory()
+        order.create()
+        order = Order.find(order.id)
+        with db.engine.begin() as connection:
+            connection.execute(update(Order).where(Order.id == order.id).values(version=Order.version + 1))
+        order.address = "1 Main St"
+        self.assertRaises(StaleDataError, order.update)
+        db.session.rollback()
+        self.assertNotEqual(Order.find(order.id).address, "1 Main St")
+
+    def test_plan_items(self):
+        """It should match the wanted items by id, then by product"""
+        Row = namedtuple("Row", "id product_id quantity total")
+        current = [Row(1, 10, 1, 1.0), Row(2, 20, 1, 1.0), Row(3, 30, 1, 1.0), Row(4, 10, 1, 1.0)]
+        wanted = [
+            {"id": "2", "product_id": 21, "quantity": 1, "total": 1.0},
+            {"id": None, "product_id": 10, "quantity": 1, "total": 1.0},
+            {"id": 99, "product_id": 10, "quantity": 3, "total": 3.0},
+            {"id": "x", "product_id": 40, "quantity": 1, "total": 1.0},
+        ]
+        inserts, updates, deletes = plan_items(current, wanted)
+        self.assertEqual(inserts, [{"product_id": 40, "quantity": 1, "total": 1.0}])
+        self.assertEqual(sorted(item["id"] for item in updates), [2, 4])
+        self.assertEqual(deletes, [3])
+        self.assertEqual(plan_items(current, []), ([], [], [1, 2, 3, 4]))
+
+    def test_replace_items(self):
+        """It should make the given items the items of an order"""
+        order = OrderFactory()
+        order.items = [ItemFactory(order=order, product_id=1), ItemFactory(order=order, product_id=2)]
+        order.create()
+        kept = order.items[0]
+        order = Order.find(order.id)
+        order.replace_items([{"id": kept.id, "product_id": 1, "quantity": 2, "total": 4.0}])
+        order.update()
+        order = Order.find(order.id)
+        self.assertEqual([(item.id, item.total) for item in order.items], [(kept.id, 4.0)])
+        self.assertEqual((order.item_count, order.items_total, order.version), (1, 4.0, 2))
+        self.assertRaises(DataValidationError, order.replace_items, {"product_id": 1})
+        self.assertRaises(DataValidationError, order.replace_items, [{"product_id": 1, "quantity": 0, "total": 1.0}])
+
+    def test_patch(self):
+        """It should change some fields of an order or an item without loading them"""
+        order = OrderFactory(address="1 Main St")
+        order.items = [ItemFactory(order=order, total=1.0)]
+        order.create()
+        data = Order.patch(order.id, Order.parse_changes({"address": "2 Main St", "date": "2023-07-02"}))
+        self.assertEqual((data["address"], data["date"], data["version"]), ("2 Main St", "2023-07-02", 2))
+        self.assertIsNone(Order.patch(order.id, {"address": "3 Main St"}, version=1))
+        self.assertIsNone(Order.patch("foo", {"address": "3 Main St"}))
+
+        data = Item.patch(order.id, order.items[0].id, Item.parse_changes({"total": 4.0}))
+        self.assertEqual((data["total"], data["order_id"]), (4.0, order.id))
+        self.assertIsNone(Item.patch(order.id + 1, order.items[0].id, {"total": 4.0}))
+        order = Order.find(order.id)
+        self.assertEqual((order.items_total, order.version, order.address), (4.0, 3, "2 Main St"))
+        with self.assertRaises(DataValidationError) as context:
+            Order.patch(order.id, {"payment": "CASH"})
+        self.assertNotIn("CASH", str(context.exception))
+        self.assertRaises(DataValidationError, Item.parse_changes, {"quantity": -1})
+
+    def test_parse_changes_bad_columns(self):
+        """It should check the changes against their columns"""
+        self.assertEqual(Item.parse_changes({"quantity": "2", "total": 3}), {"quantity": 2, "total": 3.0})
+        for changes in ({"quantity": "0"}, {"quantity": "many"}, {"quantity": 1.5}, {"product_id": 2**31}, {"total": True}):
+            self.assertRaises(DataValidationError, Item.parse_changes, changes)
+        for changes in ({"payment": "CASH"}, {"status": "LOST"}, {"address": 5}, {"date": 20230701}, {"customer_id": "x"}):
+            self.assertRaises(DataValidationError, Order.parse_changes, changes)
+        with self.assertRaises(DataValidationError) as context:
+            Order.parse_changes({"payment": "CASH"})
+        self.assertIn("payment must be one of", str(context.exception))
+
+    def test_patch_status_transition(self):
+        """It should only patch the status of an order to one its status may move to"""
+        order = OrderFactory(status="OPEN")
+        order.create()
+        self.assertEqual(Order.patch(order.id, {"status": "CANCELLED"})["status"], "CANCELLED")
+        self.assertIsNone(Order.patch(order.id, {"status": "OPEN"}))
+        self.assertEqual(Order.patch(order.id, {"status": "CANCELLED", "address": "2 Main St"})["address"], "2 Main St")
+        self.assertIsNone(Order.patch(order.id, {"status": "SHIPPING", "address": "1 Main St"}))
+        self.assertEqual(Order.find(order.id).status, "CANCELLED")
+
+    def test_customer_summary(self):
+        """It should maintain the customer summary on every change of an order"""
+        order = OrderFactory(customer_id=7, total=10.0, status=None, date=date(2023, 7, 1))
+        order.create()
+        OrderFactory(customer_id=7, total=5.0, status="SHIPPING", date=date(2023, 7, 9)).create()
+        summary = CustomerSummary.find(7).serialize()
+        self.assertEqual(summary["order_count"], 2)
+        self.assertEqual(summary["status_counts"]["OPEN"], 1)
+        self.assertEqual(summary["status_counts"]["SHIPPING"], 1)
+        self.assertEqual(summary["total"], 15.0)
+        self.assertEqual(summary["last_order_date"], "2023-07-09")
+
+        order.total = 20.0
+        order.status = "CANCELLED"
+        order.update()
+        Order.transition("DELIVERED", customer_id=7, from_status="SHIPPING")
+        db.session.expire_all()
+        summary = CustomerSummary.find(7).serialize()
+        self.assertEqual(summary["status_counts"], {"OPEN": 0, "SHIPPING": 0, "DELIVERED": 1, "CANCELLED": 1})
+        self.assertEqual(summary["total"], 25.0)
+
+        order.customer_id = 8
+        order.update()
+        db.session.expire_all()
+        self.assertEqual(CustomerSummary.find(7).order_count, 1)
+        self.assertEqual(CustomerSummary.find(7).last_order_date, date(2023, 7, 9))
+        self.assertEqual(CustomerSummary.find(8).cancelled_count, 1)
+
+    def test_customer_summary_rebuild(self):
+        """It should rebuild the customer summaries from the orders"""
+        Order.create_many([OrderFactory(customer_id=7, total=2.0) for _ in range(3)])
+        self.assertEqual(CustomerSummary.find(7).order_count, 3)
+        db.session.query(CustomerSummary).delete()
+        db.session.commit()
+        CustomerSummary.rebuild()
+        summary = CustomerSummary.find(7)
+        self.assertEqual(summary.order_count, 3)
+        self.assertEqual(summary.total, 6.0)
+
+    def test_customer_summary_refresh_concurrently(self):
+        """It should refresh the summary of a customer from two transactions at once"""
+        order = OrderFactory(customer_id=7, total=2.0)
+        order.create()
+        engine, errors = db.engine, []
+
+        def refresh():
+            try:
+                with engine.connect() as connection:
+                    CustomerSummary.refresh(connection, {7})
+                    connection.commit()
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        with engine.connect() as connection:
+            CustomerSummary.refresh(connection, {7})
+            other = threading.Thread(target=refresh)
+            other.start()
+            # let the other refresh wait for the row this one wrote
+            time.sleep(0.2)
+            connection.commit()
+        other.join()
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+        self.assertEqual(CustomerSummary.find(7).order_count, 1)
+
+        order.delete()
+        self.assertIsNone(db.session.get(CustomerSummary, 7))
+
+    def test_stats(self):
+        """It should aggregate the order totals by payment"""
+        for total in (10.0, 30.0):
+            OrderFactory(payment="VEMO", total=total).create()
+        OrderFactory(payment="CREDITCARD", total=5.0).create()
+        stats = Order.stats(Order.query, "payment")
+        self.assertEqual(len(stats), 2)
+        vemo = [row for row in stats if row["group"] == "VEMO"][0]
+        self.assertEqual(vemo["count"], 2)
+        self.assertEqual(vemo["sum"], 40.0)
+        self.assertEqual(vemo["average"], 20.0)
+        self.assertEqual((vemo["min"], vemo["max"]), (10.0, 30.0))
+
     ######################################################################
     #  TEST SERIALIZE / DESERIALIZE ORDER
     ######################################################################
@@ -217,6 +482,16 @@ class TestOrder(unittest.TestCase):
         self.assertEqual(items[0]["total"], item.total)
         self.assertEqual(items[0]["order_id"], item.order_id)
 
+    def test_serialize_order_fields(self):
+        """It should Serialize only the given fields of an order"""
+        order = OrderFactory()
+        order.create()
+        expected = {"id": order.id, "status": order.status, "total": order.total}
+        db.session.expunge_all()
+        same_order = Order.find(expected["id"], ["status", "total"])
+        self.assertEqual(same_order.serialize(["id", "status", "total"]), expected)
+        self.assertNotIn("address", same_order.__dict__)
+
     def test_deserialize_an_order(self):
         """It should Deserialize an order"""
         order = OrderFactory()
@@ -254,6 +529,14 @@ class TestOrder(unittest.TestCase):
             "status": "OPEN"
         })
 
+    def test_deserialize_bad_columns(self):
+        """It should not Deserialize an order the database would reject"""
+        data = OrderFactory().serialize()
+        data["payment"] = "CASH"
+        self.assertRaises(DataValidationError, Order().deserialize, data)
+        data = {"product_id": 1, "quantity": "0", "total": 1.0}
+        self.assertRaises(DataValidationError, Item().deserialize, data)
+
     def test_deserialize_item_key_error(self):
         """It should not Deserialize an item with a KeyError"""
         item = Item()
@@ -353,3 +636,136 @@ class TestOrder(unittest.TestCase):
 
         order = Order.find(order.id)
         self.assertEqual(len(order.items), 0)
+
+    def test_item_counters(self):
+        """It should keep the item count and items total of an order in step"""
+        order = OrderFactory()
+        order.items = [ItemFactory(order=order, total=2.5), ItemFactory(order=order, total=4.0)]
+        order.create()
+        self.assertEqual((order.item_count, order.items_total), (2, 6.5))
+
+        item = Item(product_id=1, quantity=1, total=10.0)
+        order.items.append(item)
+        order.update()
+        order = Order.find(order.id)
+        self.assertEqual((order.item_count, order.items_total), (3, 16.5))
+
+        item = Item.find(item.id)
+        item.total = 1.0
+        item.update()
+        item.delete()
+        order = Order.find(order.id)
+        self.assertEqual((order.item_count, order.items_total), (2, 6.5))
+
+    def test_create_for_order(self):
+        """It should add an item only to an order that is not cancelled"""
+        order = OrderFactory(status="OPEN")
+        order.items = [ItemFactory(order=order, total=2.0)]
+        order.create()
+        item = Item(product_id=1, quantity=2, total=3.0)
+        self.assertTrue(item.create_for_order(order.id))
+        self.assertEqual(item.order_id, order.id)
+        self.assertEqual(Item.find(item.id).total, 3.0)
+        order = Order.find(order.id)
+        self.assertEqual((order.item_count, order.items_total), (2, 5.0))
+
+        order.status = "CANCELLED"
+        order.update()
+        self.assertFalse(Item(product_id=1, quantity=1, total=1.0).create_for_order(order.id))
+        self.assertFalse(Item(product_id=1, quantity=1, total=1.0).create_for_order(0))
+        self.assertFalse(Item(product_id=1, quantity=1, total=1.0).create_for_order("foo"))
+        self.assertEqual(len(Item.find_by_order_id(order.id).all()), 2)
+
+    def test_idempotency_key(self):
+        """It should claim a key once and keep the response stored for it"""
+        self.assertIsNone(IdempotencyKey.claim("retry-1", "a" * 64, 60))
+        stored = IdempotencyKey.claim("retry-1", "a" * 64, 60)
+        self.assertIsNone(stored.status)
+        IdempotencyKey.complete("retry-1", 201, b'{"id":1}', "http://localhost/api/orders/1")
+        stored = IdempotencyKey.claim("retry-1", "b" * 64, 60)
+        self.assertEqual((stored.fingerprint, stored.status, stored.body), ("a" * 64, 201, b'{"id":1}'))
+        IdempotencyKey.release("retry-1")
+        self.assertIsNotNone(IdempotencyKey.claim("retry-1", "a" * 64, 60))
+
+        self.assertIsNone(IdempotencyKey.claim("retry-2", "a" * 64, 60))
+        IdempotencyKey.release("retry-2")
+        self.assertIsNone(IdempotencyKey.claim("retry-2", "a" * 64, 60))
+
+    def test_idempotency_key_expired(self):
+        """It should reuse and purge the keys that expired"""
+        self.assertIsNone(IdempotencyKey.claim("old", "a" * 64, -1))
+        IdempotencyKey.complete("old", 201, b"{}", ttl=-1)
+        self.assertIsNone(IdempotencyKey.claim("old", "b" * 64, -1))
+        self.assertIsNone(IdempotencyKey.claim("new", "a" * 64, 60))
+        self.assertEqual(IdempotencyKey.purge(), 1)
+        self.assertEqual([key.key for key in IdempotencyKey.query.all()], ["new"])
+
+    def test_idempotency_key_lease(self):
+        """It should free a claimed key after its lease and keep a response for the TTL"""
+        self.assertIsNone(IdempotencyKey.claim("dead", "a" * 64, -1))
+        self.assertIsNone(IdempotencyKey.claim("dead", "a" * 64, 60))
+        self.assertIsNotNone(IdempotencyKey.claim("dead", "a" * 64, 60))
+
+        self.assertIsNone(IdempotencyKey.claim("done", "a" * 64, -1))
+        IdempotencyKey.complete("done", 201, b"{}", ttl=60)
+        stored = IdempotencyKey.claim("done", "a" * 64, 60)
+        self.assertEqual((stored.status, stored.body), (201, b"{}"))
+
+    def test_rebuild_item_counters(self):
+        """It should rebuild the item counters of every order"""
+        order = OrderFactory()
+        order.items = [ItemFactory(order=order, total=3.0) for _ in range(3)]
+        order.create()
+        empty = OrderFactory()
+        empty.create()
+        db.session.query(Order).update({"item_count": 0, "items_total": 0.0})
+        db.session.commit()
+        self.assertEqual(Order.rebuild_item_counters(), 2)
+        self.assertEqual((Order.find(order.id).item_count, Order.find(order.id).items_total), (3, 9.0))
+        self.assertEqual(Order.find(empty.id).item_count, 0)
+
+    def test_find_missing_cached(self):
+        """It should remember the ids that were not found until they are committed"""
+        other = Session(db.engine)
+        order = OrderFactory()
+        order.id = None
+        other.add(order)
+        other.flush()
+        order_id = order.id
+        with tempfile.TemporaryDirectory() as folder:
+            missing = SQLiteCache(os.path.join(folder, "missing.db"), ttl=60)
+            with patch.object(BaseModel, "missing", missing):
+                # the id is taken but not committed yet
+                self.assertIsNone(Order.find(order_id))
+                self.assertIsNone(Order.find(order_id))
+                self.assertEqual(missing.hits, 1)
+                other.commit()
+                other.close()
+                self.assertIsNotNone(Order.find(order_id))
+
+    def test_missing_cache_backend(self):
+        """It should keep a bounded negative cache on the cache backend"""
+        with patch.object(BaseModel, "cache"), patch.object(BaseModel, "missing"):
+            with patch.dict(app.config, CACHE_BACKEND="memory", CACHE_MISSING_MAXSIZE=3, CACHE_MISSING_TTL=2.0):
+                Order.init_db(app)
+                self.assertIsInstance(BaseModel.cache, LRUCache)
+                self.assertIsInstance(BaseModel.missing, LRUCache)
+                self.assertEqual((BaseModel.missing.maxsize, BaseModel.missing.ttl), (3, 2.0))
+            with patch.dict(app.config, CACHE_BACKEND="null"):
+                Order.init_db(app)
+                self.assertIsInstance(BaseModel.missing, NullCache)
+
+    def test_create_clears_missing(self):
+        """It should clear the shared negative cache entry of a created id"""
+        with tempfile.TemporaryDirectory() as folder:
+            missing = SQLiteCache(os.path.join(folder, "missing.db"), ttl=60)
+            with patch.object(BaseModel, "missing", missing):
+                order = OrderFactory()
+                order.create()
+                self.assertIsNone(Order.find(order.id + 1))
+                self.assertEqual(missing.get(Order.missing_key(order.id + 1)), True)
+                order = OrderFactory()
+                order.items = [ItemFactory(order=order)]
+                order.create()
+                self.assertIsNotNone(Order.find(order.id))
+                self.assertIsNone(missing.get(Order.missing_key(order.id)))
@@ -6,15 +6,24 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import gzip
+import json
+import tempfile
 import logging
+from contextlib import contextmanager
 from unittest import TestCase
-# from unittest.mock import MagicMock, patch
+from sqlalchemy import create_engine, event, update
+from unittest.mock import patch
 from service import app
 # from service.models import Item
-from service.models import db, Order, init_db
+from service.models import db, BaseModel, Order, Item, CustomerSummary, IdempotencyKey, init_db
 from tests.factories import ItemFactory, OrderFactory
 from service.common import status  # HTTP Status Codes
-# from datetime import date
+from service.common.cache import LRUCache, NullCache, SQLiteCache
+from service.common.group_commit import GroupCommit
+from service.common.health import check_database
+from service.routes import database_check
+from datetime import date
 from itertools import cycle
 
 
@@ -52,7 +61,14 @@ class TestOrderServer(TestCase):
 
         self.client = app.test_client()
         db.session.query(Order).delete()  # clean up the last tests
+        db.session.query(CustomerSummary).delete()
+        db.session.query(IdempotencyKey).delete()
         db.session.commit()
+        # a single worker, so the per worker cache is never stale
+        cache_patch = patch.object(BaseModel, "cache", LRUCache(maxsize=1000, ttl=60))
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        Order.missing.clear()
 
     def tearDown(self):
         """Runs once after each test case"""
@@ -90,6 +106,28 @@ class TestOrderServer(TestCase):
 
         return orders
 
+    @contextmanager
+    def _count_queries(self):
+        """ Counts the SQL statements sent to the database inside the block """
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_execute)
+
+    def _page_link(self, resp, rel):
+        """ Returns the url of a page from the Link header of a response """
+        for link in resp.headers["Link"].split(", "):
+            url, link_rel = link.split("; ")
+            if link_rel == f'rel="{rel}"':
+                return url.strip("<>")
+        return None
+
     # ---------------------------------------------------------------------
     #               O R D E R  M E T H O D S
     # ---------------------------------------------------------------------
@@ -122,6 +160,69 @@ class TestOrderServer(TestCase):
         self.assertEqual(data["customer_id"], order.customer_id, "customer_id does not match")
         self.assertEqual(data["status"], order.status, "status does not match")
 
+    def test_create_order_idempotent(self):
+        """It should answer a retried create from the stored response"""
+        order = OrderFactory()
+        headers = {"Idempotency-Key": "checkout-1"}
+        resp = self.client.post(BASE_URL, json=order.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+        created = resp.get_json()
+
+        with self._count_queries() as statements:
+            with patch.object(Order, "deserialize") as deserialize:
+                resp = self.client.post(BASE_URL, json=order.serialize(), headers=headers)
+        deserialize.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json(), created)
+        self.assertEqual(resp.headers["Location"], f"http://localhost{BASE_URL}/{created['id']}")
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+        self.assertFalse([statement for statement in statements if "INSERT INTO \"order\"" in statement])
+        self.assertEqual(len(Order.all()), 1)
+
+        resp = self.client.post(BASE_URL, json={**order.serialize(), "total": 1.0}, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        resp = self.client.post(BASE_URL, json=order.serialize(), headers={"Idempotency-Key": "x" * 256})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_order_idempotent_in_progress(self):
+        """It should refuse a retry while the first request runs, and allow one after it failed"""
+        order = OrderFactory()
+        IdempotencyKey.claim("checkout-2", "0" * 64, 60)
+        resp = self.client.post(BASE_URL, json=order.serialize(), headers={"Idempotency-Key": "checkout-2"})
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        data = {"items": []}
+        headers = {"Idempotency-Key": "checkout-3"}
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with patch("service.common.idempotency.request_fingerprint", return_value="0" * 64):
+            resp = self.client.post(BASE_URL, json=order.serialize(), headers={"Idempotency-Key": "checkout-2"})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+        IdempotencyKey.claim("checkout-4", "0" * 64, -1)
+        with patch("service.common.idempotency.request_fingerprint", return_value="0" * 64):
+            resp = self.client.post(BASE_URL, json=order.serialize(), headers={"Idempotency-Key": "checkout-4"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_bad_request_without_propagation(self):
+        """It should answer 400 to bad data when exceptions are not propagated"""
+        order = self._create_orders(1)[0]
+        with patch.dict(app.config, TESTING=False, PROPAGATE_EXCEPTIONS=False):
+            for resp in (
+                self.client.get(BASE_URL, query_string="cursor=xx"),
+                self.client.get(BASE_URL, query_string="limit=0"),
+                self.client.get(BASE_URL, query_string="fields=nope"),
+                self.client.post(f"{BASE_URL}/batch", json={"orders": []}),
+                self.client.put(f"{BASE_URL}/transition", json={"status": "OPEN", "ids": [1]}),
+                self.client.patch(f"{BASE_URL}/{order.id}", json={"id": 5}),
+            ):
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(resp.get_json()["error"], "Bad Request")
+
     def test_create_order_missing_info(self):
         """
         It should fail if the call has some missing information.
@@ -138,6 +239,69 @@ class TestOrderServer(TestCase):
         orders = Order.all()
         self.assertEqual(len(orders), 0)
 
+    def test_create_orders_batch(self):
+        """It should create a batch of orders with batched INSERTs"""
+        payload = []
+        for _ in range(50):
+            order = OrderFactory(status="OPEN")
+            data = order.serialize()
+            data["items"] = [ItemFactory(order=order).serialize() for _ in range(2)]
+            payload.append(data)
+
+        with self._count_queries() as statements:
+            resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data["ids"]), 50)
+        self.assertEqual(data["errors"], [])
+        self.assertEqual(len(Order.all()), 50)
+        self.assertEqual(len(Order.find(data["ids"][0]).items), 2)
+        inserts = [statement for statement in statements if statement.startswith("INSERT")]
+        # one for the orders, one for the items and one upsert of the customer summaries
+        self.assertEqual(len(inserts), 3)
+        self.assertTrue(inserts[-1].startswith("INSERT INTO customer_summary"))
+
+    def test_create_orders_batch_atomic(self):
+        """It should not create any order of a batch with an invalid one"""
+        payload = [OrderFactory().serialize(), {"total": 1.0}]
+        resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        data = resp.get_json()
+        self.assertEqual(data["ids"], [])
+        self.assertEqual(data["errors"][0]["index"], 1)
+        self.assertEqual(len(Order.all()), 0)
+
+    def test_create_orders_batch_partial(self):
+        """It should create the valid orders of a non atomic batch"""
+        payload = [OrderFactory().serialize(), {"total": 1.0}, OrderFactory().serialize()]
+        resp = self.client.post(f"{BASE_URL}/batch", query_string="atomic=false", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data["ids"]), 2)
+        self.assertEqual([error["index"] for error in data["errors"]], [1])
+        self.assertEqual(len(Order.all()), 2)
+
+    def test_create_orders_batch_bad_columns(self):
+        """It should skip the orders the database would reject in a non atomic batch"""
+        missing, cash, long = (OrderFactory().serialize() for _ in range(3))
+        del missing["payment"]
+        cash["payment"] = "CASH"
+        long["address"] = "x" * 101
+        payload = [missing, OrderFactory().serialize(), cash, long]
+        resp = self.client.post(f"{BASE_URL}/batch", query_string="atomic=false", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data["ids"]), 1)
+        self.assertEqual([error["index"] for error in data["errors"]], [0, 2, 3])
+        self.assertEqual(data["errors"][0]["message"], "Invalid order: missing payment")
+        self.assertNotIn("INSERT", resp.get_data(as_text=True))
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_create_orders_batch_not_a_list(self):
+        """It should not create a batch that is not a list"""
+        resp = self.client.post(f"{BASE_URL}/batch", json=OrderFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     ######################################################################
     #  TEST LIST ORDER
     ######################################################################
@@ -175,6 +339,127 @@ class TestOrderServer(TestCase):
         self.assertEqual(data[0]["status"], orders[1].status)
         self.assertEqual(data[0]["customer_id"], orders[1].customer_id)
 
+    def test_list_orders_query_count(self):
+        """It should list orders with items in a constant number of queries"""
+        for _ in range(1000):
+            order = OrderFactory(id=None)
+            order.items = [ItemFactory(id=None, order=None, order_id=None) for _ in range(2)]
+            db.session.add(order)
+        db.session.commit()
+
+        with self._count_queries() as statements:
+            resp = self.client.get(BASE_URL, query_string="limit=1000")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1000)
+        # one page query plus the batched item loads, never one per order
+        self.assertLessEqual(len(statements), 4)
+
+    def test_list_orders_paginated(self):
+        """It should page through orders with the Link header"""
+        orders = self._create_orders(5)
+        resp = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn('rel="next"', resp.headers["Link"])
+        self.assertNotIn('rel="prev"', resp.headers["Link"])
+
+        seen = [order["id"] for order in resp.get_json()]
+        while 'rel="next"' in resp.headers.get("Link", ""):
+            resp = self.client.get(self._page_link(resp, "next"))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertIn('rel="prev"', resp.headers["Link"])
+            seen.extend(order["id"] for order in resp.get_json())
+        self.assertEqual(sorted(seen), sorted(order.id for order in orders))
+
+        # walk back to the previous page from the last one
+        resp = self.client.get(self._page_link(resp, "prev"))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([order["id"] for order in resp.get_json()], seen[2:4])
+
+    def test_list_orders_page_limit_capped(self):
+        """It should cap the page size at the server side maximum"""
+        self._create_orders(3)
+        app.config["ORDERS_PAGE_MAX"] = 2
+        try:
+            resp = self.client.get(BASE_URL, query_string="limit=50")
+        finally:
+            app.config["ORDERS_PAGE_MAX"] = 1000
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_list_orders_bad_page_args(self):
+        """It should not list orders with a bad limit or cursor"""
+        resp = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_orders(self):
+        """It should stream all orders as newline delimited JSON"""
+        orders = self._create_orders(5)
+        resp = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual(sorted(order["id"] for order in data), sorted(order.id for order in orders))
+
+    def test_stream_orders_by_status(self):
+        """It should stream the orders that match a filter"""
+        orders = self._create_orders(4)
+        resp = self.client.get(BASE_URL, query_string=f"stream=true&status={orders[0].status}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        data = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["id"], orders[0].id)
+
+    def test_list_orders_compressed(self):
+        """It should gzip order listings and report the ratio in the metrics"""
+        self._create_orders(20)
+        resp = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(resp.data))), 20)
+
+        resp = self.client.get(
+            BASE_URL, query_string="stream=true", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(gzip.decompress(resp.data).splitlines()), 20)
+
+        stats = self.client.get("/metrics").get_json()["compression"]
+        self.assertIn("gzip", stats["algorithms"])
+        self.assertGreater(stats["gzip"]["ratio"], 1)
+
+    def test_list_orders_sparse_fields(self):
+        """It should list only the requested fields of orders"""
+        self._create_orders(3)
+        with self._count_queries() as statements:
+            resp = self.client.get(BASE_URL, query_string="fields=id,status,total")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 3)
+        for order in data:
+            self.assertEqual(set(order.keys()), {"id", "status", "total"})
+        # the items relationship is not loaded when it is not requested
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("address", statements[0])
+
+    def test_list_orders_sparse_fields_paginated(self):
+        """It should keep the requested fields on the next page"""
+        self._create_orders(3)
+        resp = self.client.get(BASE_URL, query_string="limit=2&fields=id,status")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(self._page_link(resp, "next"))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([set(order) for order in resp.get_json()], [{"id", "status"}])
+
+    def test_list_orders_bad_fields(self):
+        """It should not list orders with an unknown field"""
+        resp = self.client.get(BASE_URL, query_string="fields=id,secret")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     ######################################################################
     #  TEST GET ORDER
     ######################################################################
@@ -190,6 +475,273 @@ class TestOrderServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data["id"], order.id)
 
+    def test_get_order_sparse_fields(self):
+        """It should Read only the requested fields of an Order"""
+        order = self._create_orders(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="fields=id,items")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"id": order.id, "items": []})
+
+    def test_get_order_cached(self):
+        """It should Read an Order from the cache after the first read"""
+        order = self._create_orders(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        hits = Order.cache.hits
+        with self._count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/{order.id}")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(statements, [])
+        self.assertEqual(Order.cache.hits, hits + 2)
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["cache"]["hits"], hits + 2)
+
+    def test_cache_invalidated_on_writes(self):
+        """It should not serve a cached Order after it changes"""
+        order = self._create_orders(1)[0]
+        self.client.get(f"{BASE_URL}/{order.id}")
+
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory(order=order).serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item = resp.get_json()
+        self.assertEqual(len(self.client.get(f"{BASE_URL}/{order.id}/items").get_json()), 1)
+
+        item["quantity"] = 9
+        self.client.put(f"{BASE_URL}/{order.id}/items/{item['id']}", json=item)
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+        self.assertEqual(resp.get_json()[0]["quantity"], 9)
+
+        self.client.delete(f"{BASE_URL}/{order.id}/items/{item['id']}")
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["items"], [])
+
+        order.total = 1.0
+        self.client.put(f"{BASE_URL}/{order.id}", json=order.serialize())
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["total"], 1.0)
+
+        self.client.put(f"{BASE_URL}/{order.id}/cancel")
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["status"], "CANCELLED")
+
+        self.client.delete(f"{BASE_URL}/{order.id}")
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_shared_cache_between_workers(self):
+        """It should not serve a stale Order from a shared cache after another worker changes it"""
+        order = self._create_orders(1)[0]
+        item = self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory(order=order).serialize()).get_json()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "cache.db")
+            first, second = SQLiteCache(path, ttl=60), SQLiteCache(path, ttl=60)
+            with patch.object(BaseModel, "cache", first):
+                self.client.get(f"{BASE_URL}/{order.id}")
+            with patch.object(BaseModel, "cache", second):
+                with self._count_queries() as statements:
+                    resp = self.client.get(f"{BASE_URL}/{order.id}/items/{item['id']}")
+                self.assertEqual(resp.get_json()["quantity"], item["quantity"])
+                self.assertEqual(statements, [])
+                self.client.put(f"{BASE_URL}/{order.id}/items/{item['id']}", json={**item, "quantity": 9})
+            with patch.object(BaseModel, "cache", first):
+                resp = self.client.get(f"{BASE_URL}/{order.id}/items/{item['id']}")
+                self.assertEqual(resp.get_json()["quantity"], 9)
+                self.assertEqual(first.hits, 0)
+
+    def test_missing_order_cached(self):
+        """It should answer repeated lookups of a deleted Order without a query"""
+        orders = self._create_orders(2)
+        self.client.delete(f"{BASE_URL}/{orders[0].id}")
+        with tempfile.TemporaryDirectory() as folder:
+            missing = SQLiteCache(os.path.join(folder, "missing.db"), ttl=60)
+            with patch.object(BaseModel, "missing", missing):
+                resp = self.client.get(f"{BASE_URL}/{orders[0].id}")
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+                with self._count_queries() as statements:
+                    resp = self.client.get(f"{BASE_URL}/{orders[0].id}")
+                    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+                    resp = self.client.put(f"{BASE_URL}/{orders[0].id}/cancel")
+                    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+                self.assertEqual(statements, [])
+                self.assertEqual(self.client.get("/metrics").get_json()["missing"]["hits"], 2)
+
+    def test_missing_order_created_later(self):
+        """It should not remember a missing id the next Order could get"""
+        order = self._create_orders(1)[0]
+        next_id = int(order.id) + 1
+        self.assertEqual(self.client.get(f"{BASE_URL}/{next_id}").status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.post(BASE_URL, json=OrderFactory().serialize())
+        self.assertEqual(int(resp.get_json()["id"]), next_id)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{next_id}").status_code, status.HTTP_200_OK)
+
+    def test_cache_invalidated_on_transition(self):
+        """It should not serve a cached Order after a bulk transition"""
+        order = self._create_orders(1)[0]
+        self.client.get(f"{BASE_URL}/{order.id}")
+        self.client.put(f"{BASE_URL}/transition", json={"status": "SHIPPING", "ids": [int(order.id)]})
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["status"], "SHIPPING")
+
+    def test_get_order_not_modified(self):
+        """It should answer 304 Not Modified to a matching If-None-Match"""
+        order = self._create_orders(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith('"'))
+
+        resp = self.client.get(f"{BASE_URL}/{order.id}", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.get_data(), b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        self.client.put(f"{BASE_URL}/{order.id}/cancel")
+        resp = self.client.get(f"{BASE_URL}/{order.id}", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_update_order_if_match(self):
+        """It should only update an order at the version in If-Match"""
+        order = self._create_orders(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="fields=id")
+        self.assertEqual(resp.headers["ETag"], '"1;id"')
+        data = {**order.serialize(), "address": "1 Main St"}
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": '"1;id"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        self.assertEqual(resp.get_json()["version"], 2)
+
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertFalse([statement for statement in statements if statement.startswith("UPDATE")])
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": 'W/"2", "3"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        data["address"] = "2 Main St"
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": 'W/"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data["address"] = "3 Main St"
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").headers["ETag"], '"4"')
+
+    def test_update_order_lost_update(self):
+        """It should refuse an update that lost to another writer"""
+        order = self._create_orders(1)[0]
+
+        def concurrent_write(loaded, data, with_items=True):  # pylint: disable=unused-argument
+            with db.engine.begin() as connection:
+                connection.execute(update(Order).where(Order.id == order.id).values(version=Order.version + 1))
+            loaded.address = "1 Main St"
+            return loaded
+
+        with patch.object(Order, "deserialize", autospec=True, side_effect=concurrent_write):
+            resp = self.client.put(f"{BASE_URL}/{order.id}", json=order.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+            resp = self.client.put(f"{BASE_URL}/{order.id}", json=order.serialize(), headers={"If-Match": '"2"'})
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["version"], 3)
+
+    def test_cancel_order_if_match(self):
+        """It should only cancel an order at the version in If-Match"""
+        order = self._create_orders(1)[0]
+        resp = self.client.put(f"{BASE_URL}/{order.id}/cancel", headers={"If-Match": '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        with patch.dict(app.config, ORDERS_IF_MATCH_REQUIRED=True):
+            resp = self.client.put(f"{BASE_URL}/{order.id}/cancel")
+            self.assertEqual(resp.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+            resp = self.client.put(f"{BASE_URL}/{order.id}/cancel", headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        self.assertEqual(resp.get_json()["status"], "CANCELLED")
+
+    def test_delete_order_if_match(self):
+        """It should only delete an order at the version in If-Match"""
+        order = self._create_orders(1)[0]
+        resp = self.client.delete(f"{BASE_URL}/{order.id}", headers={"If-Match": '"999"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        with patch.dict(app.config, ORDERS_IF_MATCH_REQUIRED=True):
+            resp = self.client.delete(f"{BASE_URL}/{order.id}")
+            self.assertEqual(resp.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+            self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").status_code, status.HTTP_200_OK)
+            resp = self.client.delete(f"{BASE_URL}/{order.id}", headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_items_not_modified(self):
+        """It should answer 304 Not Modified for unchanged items"""
+        order = self._create_orders(1)[0]
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory(order=order).serialize())
+        item_id = resp.get_json()["id"]
+        for url in (f"{BASE_URL}/{order.id}/items", f"{BASE_URL}/{order.id}/items/{item_id}"):
+            etag = self.client.get(url).headers["ETag"]
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            resp = self.client.get(url, headers={"If-None-Match": '"stale"'})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_not_modified_reads_version(self):
+        """It should answer 304 Not Modified from the version of the order alone"""
+        cache_patch = patch.object(BaseModel, "cache", NullCache())
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        order = self._create_orders(1)[0]
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory(order=order).serialize())
+        item_id = resp.get_json()["id"]
+        for url in (f"{BASE_URL}/{order.id}", f"{BASE_URL}/{order.id}/items",
+                    f"{BASE_URL}/{order.id}/items/{item_id}"):
+            etag = self.client.get(url).headers["ETag"]
+            with self._count_queries() as statements:
+                resp = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(len(statements), 1)
+            self.assertRegex(statements[0], r'^SELECT "order"\.version\s+FROM')
+
+    def test_sparse_fields_etag(self):
+        """It should send a different ETag for some of the fields"""
+        order = self._create_orders(1)[0]
+        whole = self.client.get(f"{BASE_URL}/{order.id}").headers["ETag"]
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="fields=status,id")
+        self.assertEqual(resp.headers["ETag"], '"1;id,status"')
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="fields=id", headers={"If-None-Match": whole})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"id": order.id})
+        resp = self.client.get(f"{BASE_URL}/{order.id}", headers={"If-None-Match": '"1;id,status"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_item_moves_item_etags(self):
+        """It should move the ETags of the items when one of them changes"""
+        order = self._create_orders(1)[0]
+        item = ItemFactory(order=order)
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize())
+        item_id = resp.get_json()["id"]
+        urls = (f"{BASE_URL}/{order.id}/items", f"{BASE_URL}/{order.id}/items/{item_id}")
+        etags = [self.client.get(url).headers["ETag"] for url in urls]
+
+        data = {**item.serialize(), "quantity": item.quantity + 1}
+        resp = self.client.put(f"{BASE_URL}/{order.id}/items/{item_id}", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        for url, etag in zip(urls, etags):
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_update_item_moves_order_etag(self):
+        """It should move the ETag of an order when only the quantity of an item changes"""
+        order = self._create_orders(1)[0]
+        item = ItemFactory(order=order)
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize())
+        item_id = resp.get_json()["id"]
+        url = f"{BASE_URL}/{order.id}"
+        etag = self.client.get(url).headers["ETag"]
+
+        data = {**item.serialize(), "quantity": item.quantity + 1}
+        resp = self.client.put(f"{url}/items/{item_id}", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_json()["items"][0]["quantity"], item.quantity + 1)
+
     def test_get_order_not_found(self):
         """It should not Read an Order that is not found"""
         resp = self.client.get(f"{BASE_URL}/0")
@@ -228,6 +780,132 @@ class TestOrderServer(TestCase):
         # Assert that the total of the updated order matches the new total
         self.assertEqual(updated_order["total"], new_total)
 
+    def test_group_commit(self):
+        """It should create and update Orders through the group commit"""
+        committer = GroupCommit(window=0, max_batch=8)
+        with patch.dict(app.extensions, group_commit=committer):
+            order = OrderFactory()
+            resp = self.client.post(BASE_URL, json=order.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            order_id = resp.get_json()["id"]
+            self.assertTrue(resp.headers["Location"].endswith(f"{BASE_URL}/{order_id}"))
+            self.client.get(f"{BASE_URL}/{order_id}")
+
+            resp = self.client.put(f"{BASE_URL}/{order_id}", json={**order.serialize(), "total": 42.0})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["total"], 42.0)
+            self.assertEqual(self.client.get(f"{BASE_URL}/{order_id}").get_json()["total"], 42.0)
+
+            resp = self.client.put(f"{BASE_URL}/{NONEXIST_ORDER_ID}", json=order.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+            stats = self.client.get("/metrics").get_json()["group_commit"]
+        self.assertEqual((stats["batches"], stats["writes"], stats["errors"]), (3, 3, 1))
+        self.assertEqual(stats["batch_sizes"], {"1": 3})
+
+    def test_update_order_items(self):
+        """It should replace the items of an order with the fewest statements"""
+        order = OrderFactory(status="OPEN")
+        order.items = [ItemFactory(order=order, product_id=product_id, quantity=1, total=1.0) for product_id in (1, 2, 3)]
+        order.create()
+        first, second, third = [item.id for item in order.items]
+        data = order.serialize()
+        data["items"] = [
+            {"id": str(first), "product_id": 1, "quantity": 5, "total": 5.0},
+            {"product_id": 2, "quantity": 1, "total": 1.0},
+            {"product_id": 4, "quantity": 2, "total": 2.0},
+        ]
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        writes = [" ".join(statement.split()[:3]) for statement in statements if not statement.startswith("SELECT")]
+        self.assertEqual(writes, ["DELETE FROM item", "UPDATE item SET", "INSERT INTO item", 'UPDATE "order" SET'])
+        data = resp.get_json()
+        self.assertEqual((data["item_count"], data["items_total"], data["version"]), (3, 8.0, 2))
+        items = {item["product_id"]: item for item in data["items"]}
+        self.assertEqual(sorted(items), [1, 2, 4])
+        self.assertEqual((int(items[1]["id"]), items[1]["quantity"]), (first, 5))
+        self.assertEqual(int(items[2]["id"]), second)
+        self.assertNotIn(str(third), [item["id"] for item in data["items"]])
+
+        del data["items"]
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json={**data, "address": "1 Main St"})
+        self.assertEqual(len(resp.get_json()["items"]), 3)
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json={**data, "items": None})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["items"]), 3)
+
+    def test_update_order_many_items(self):
+        """It should replace a long item list in a bounded number of statements"""
+        order = OrderFactory(status="OPEN")
+        order.items = [ItemFactory(order=order, product_id=product_id) for product_id in range(500)]
+        order.create()
+        data = order.serialize()
+        data["items"] = [
+            {**item, "quantity": item["quantity"] + 1} for item in data["items"][100:]
+        ] + [{"product_id": 1000 + number, "quantity": 1, "total": 1.0} for number in range(100)]
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertLessEqual(len(statements), 8)
+        self.assertEqual(resp.get_json()["item_count"], 500)
+        self.assertEqual(len(resp.get_json()["items"]), 500)
+
+    def test_patch_order(self):
+        """It should change only the posted fields of an order with one UPDATE"""
+        order = OrderFactory(status="OPEN", customer_id=7, total=10.0, date=date(2023, 7, 1))
+        order.items = [ItemFactory(order=order) for _ in range(3)]
+        order.create()
+        self.client.get(f"{BASE_URL}/{order.id}")
+        with self._count_queries() as statements:
+            resp = self.client.patch(f"{BASE_URL}/{order.id}", json={"address": "1 Main St"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('UPDATE "order" SET address='))
+        data = resp.get_json()
+        self.assertNotIn("items", data)
+        self.assertEqual((data["address"], data["total"], data["version"]), ("1 Main St", 10.0, 2))
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        data = self.client.get(f"{BASE_URL}/{order.id}").get_json()
+        self.assertEqual((data["address"], len(data["items"])), ("1 Main St", 3))
+
+        resp = self.client.patch(f"{BASE_URL}/{order.id}", json={"status": "CANCELLED", "customer_id": 8})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        old = self.client.get("/api/customers/7/orders/summary").get_json()
+        new = self.client.get("/api/customers/8/orders/summary").get_json()
+        self.assertEqual((old["order_count"], new["order_count"]), (0, 1))
+        self.assertEqual(new["status_counts"]["CANCELLED"], 1)
+
+    def test_patch_order_bad_request(self):
+        """It should refuse changes that are not valid"""
+        order = self._create_orders(1)[0]
+        for changes in ({}, {"items": []}, {"id": 5}, {"address": None}, {"date": "July"}, {"status": "LOST"}):
+            resp = self.client.patch(f"{BASE_URL}/{order.id}", json=changes)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, changes)
+        resp = self.client.patch(f"{BASE_URL}/{NONEXIST_ORDER_ID}", json={"address": "1 Main St"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.patch(f"{BASE_URL}/{order.id}", json={"address": "1 Main St"}, headers={"If-Match": '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.patch(f"{BASE_URL}/{order.id}", json={"address": "1 Main St"}, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.patch(f"{BASE_URL}/{order.id}", json={"total": "lots"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("SQL", resp.get_json()["message"])
+
+    def test_patch_order_status_transition(self):
+        """It should refuse to patch an order to a status it cannot move to, but accept its own"""
+        order = OrderFactory(status="OPEN")
+        order.create()
+        url = f"{BASE_URL}/{order.id}"
+        resp = self.client.patch(url, json={"status": "OPEN", "address": "b"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["address"], "b")
+        self.client.put(f"{url}/cancel")
+        resp = self.client.patch(url, json={"status": "OPEN"})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.client.patch(url, json={"status": "OPEN"}, headers={"If-Match": '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(url).get_json()["status"], "CANCELLED")
+
     def test_update_nonexist_orders(self):
         """It Should update an non-existing order"""
         resp = self.client.put(f"{BASE_URL}/{NONEXIST_ORDER_ID}")
@@ -259,6 +937,132 @@ class TestOrderServer(TestCase):
         resp = self.client.delete(f"{BASE_URL}/{NONEXIST_ORDER_ID}")
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
 
+    ######################################################################
+    #  TEST TRANSITION ORDERS
+    ######################################################################
+
+    def test_transition_orders(self):
+        """It should move the open orders of a list to shipping"""
+        orders = self._create_orders(4)
+        ids = [int(order.id) for order in orders]
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/transition", json={"status": "SHIPPING", "ids": ids})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["ids"], [ids[0]])
+        self.assertEqual(data["skipped"], ids[1:])
+        updates = [s for s in statements if not s.startswith(("DELETE FROM customer_summary", "INSERT INTO customer_summary"))]
+        self.assertEqual([s for s in updates if s.startswith("UPDATE")], updates)
+        resp = self.client.get(f"{BASE_URL}/{ids[0]}")
+        self.assertEqual(resp.get_json()["status"], "SHIPPING")
+
+    def test_transition_orders_by_filter(self):
+        """It should cancel the open orders of a customer"""
+        for order_status in ("OPEN", "OPEN", "SHIPPING"):
+            self.client.post(BASE_URL, json=OrderFactory(customer_id=7, status=order_status).serialize())
+        self.client.post(BASE_URL, json=OrderFactory(customer_id=8, status="OPEN").serialize())
+        resp = self.client.put(
+            f"{BASE_URL}/transition", json={"status": "CANCELLED", "filter": {"customer_id": 7}}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["ids"]), 2)
+        resp = self.client.get(BASE_URL, query_string="status=CANCELLED")
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_transition_orders_bad_request(self):
+        """It should not transition orders without a valid target or selection"""
+        resp = self.client.put(f"{BASE_URL}/transition", json={"status": "OPEN", "ids": [1]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(f"{BASE_URL}/transition", json={"status": "SHIPPING"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(f"{BASE_URL}/transition", json={"status": "SHIPPING", "ids": "1"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(f"{BASE_URL}/transition", json=["SHIPPING"])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  TEST ORDER STATS
+    ######################################################################
+
+    def test_order_stats(self):
+        """It should return the stats of all orders"""
+        orders = self._create_orders(4)
+        resp = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertIsNone(data[0]["group"])
+        self.assertEqual(data[0]["count"], 4)
+        self.assertAlmostEqual(data[0]["sum"], sum(order.total for order in orders))
+
+    def test_order_stats_by_status(self):
+        """It should return the stats of orders grouped by status"""
+        self._create_orders(8)
+        resp = self.client.get(f"{BASE_URL}/stats", query_string="group_by=status")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([row["group"] for row in data], ["OPEN", "SHIPPING", "DELIVERED", "CANCELLED"])
+        self.assertTrue(all(row["count"] == 2 for row in data))
+
+    def test_order_stats_by_month_with_filter(self):
+        """It should return the stats of filtered orders grouped by month"""
+        for day in (1, 15):
+            order = OrderFactory(date=date(2023, 7, day), customer_id=7, total=10.0)
+            self.client.post(BASE_URL, json=order.serialize())
+        self.client.post(BASE_URL, json=OrderFactory(customer_id=8).serialize())
+        resp = self.client.get(
+            f"{BASE_URL}/stats", query_string="group_by=date&bucket=month&customer_id=7"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["group"], "2023-07-01")
+        self.assertEqual(data[0]["count"], 2)
+        self.assertEqual(data[0]["average"], 10.0)
+
+    def test_order_stats_bad_group(self):
+        """It should not return stats grouped by an unknown field"""
+        resp = self.client.get(f"{BASE_URL}/stats", query_string="group_by=address")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  TEST CUSTOMER SUMMARY
+    ######################################################################
+
+    def test_customer_summary(self):
+        """It should keep the order summary of a customer up to date"""
+        for day, total in ((1, 10.0), (9, 20.0)):
+            order = OrderFactory(date=date(2023, 7, day), customer_id=7, total=total, status="OPEN")
+            resp = self.client.post(BASE_URL, json=order.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        first, last = [order["id"] for order in self.client.get(BASE_URL).get_json()][::-1]
+        self.client.post(BASE_URL, json=OrderFactory(customer_id=8).serialize())
+
+        resp = self.client.get("/api/customers/7/orders/summary")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["order_count"], 2)
+        self.assertEqual(data["status_counts"]["OPEN"], 2)
+        self.assertEqual(data["total"], 30.0)
+        self.assertEqual(data["last_order_date"], "2023-07-09")
+
+        self.client.put(f"{BASE_URL}/{first}/cancel")
+        self.client.delete(f"{BASE_URL}/{last}")
+        data = self.client.get("/api/customers/7/orders/summary").get_json()
+        self.assertEqual(data["order_count"], 1)
+        self.assertEqual(data["status_counts"], {"OPEN": 0, "SHIPPING": 0, "DELIVERED": 0, "CANCELLED": 1})
+        self.assertEqual(data["total"], 10.0)
+        self.assertEqual(data["last_order_date"], "2023-07-01")
+
+    def test_customer_summary_no_orders(self):
+        """It should return an empty summary for a customer without orders"""
+        resp = self.client.get("/api/customers/1234/orders/summary")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["customer_id"], 1234)
+        self.assertEqual(data["order_count"], 0)
+        self.assertIsNone(data["last_order_date"])
+
     ######################################################################
     #  TEST CANCEL ORDER
     ######################################################################
@@ -313,6 +1117,89 @@ class TestOrderServer(TestCase):
         self.assertEqual(data["total"], item.total)
         self.assertEqual(data["order_id"], order.id)
 
+    def test_item_counters(self):
+        """It should count the items of an order without loading them"""
+        order = self._create_orders(1)[0]
+        for _ in range(2):
+            item = ItemFactory(order=order, total=5.0)
+            resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item_id = resp.get_json()["id"]
+        self.client.put(f"{BASE_URL}/{order.id}/items/{item_id}", json={**item.serialize(), "total": 1.0})
+        with self._count_queries() as statements:
+            resp = self.client.get(BASE_URL, query_string="fields=id,item_count,items_total")
+        self.assertEqual(resp.get_json(), [{"id": str(order.id), "item_count": 2, "items_total": 6.0}])
+        self.assertEqual(len(statements), 1)
+
+        self.client.delete(f"{BASE_URL}/{order.id}/items/{item_id}")
+        data = self.client.get(f"{BASE_URL}/{order.id}").get_json()
+        self.assertEqual((data["item_count"], data["items_total"]), (1, 5.0))
+
+    def test_add_item_single_statement(self):
+        """It should add an item to a large order in one statement"""
+        order = OrderFactory(status="OPEN")
+        order.items = [ItemFactory(order=order) for _ in range(200)]
+        order.create()
+        item = ItemFactory(order=order, total=2.5)
+        self.client.get(f"{BASE_URL}/{order.id}")
+        with self._count_queries() as statements:
+            resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("WITH"))
+        data = self.client.get(f"{BASE_URL}/{order.id}").get_json()
+        self.assertEqual(data["item_count"], 201)
+        self.assertIn(resp.get_json()["id"], [each["id"] for each in data["items"]])
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items/{resp.get_json()['id']}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_add_item_lost_race(self):
+        """It should not report an item that was not added to an order that is not cancelled"""
+        order = self._create_orders(1)[0]
+        item = ItemFactory(order=order).serialize()
+        with patch.object(Item, "create_for_order", return_value=False):
+            resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", data="quantity=1")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", data="{", content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}/items").get_json(), [])
+
+    def test_add_item_idempotent(self):
+        """It should add an item once when the request is retried"""
+        order = self._create_orders(1)[0]
+        item = ItemFactory(order=order)
+        headers = {"Idempotency-Key": "add-item-1"}
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        again = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize(), headers=headers)
+        self.assertEqual(again.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(again.get_json(), resp.get_json())
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["item_count"], 1)
+
+    def test_patch_item(self):
+        """It should change only the posted fields of an item in one statement"""
+        order = OrderFactory(status="OPEN")
+        order.items = [ItemFactory(order=order, total=2.0, quantity=1) for _ in range(2)]
+        order.create()
+        order_id, item_id = order.id, order.items[0].id
+        with self._count_queries() as statements:
+            resp = self.client.patch(f"{BASE_URL}/{order_id}/items/{item_id}", json={"total": 5.0})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual((resp.get_json()["total"], resp.get_json()["quantity"]), (5.0, 1))
+        data = self.client.get(f"{BASE_URL}/{order_id}").get_json()
+        self.assertEqual((data["items_total"], data["version"]), (7.0, 2))
+
+        other = self._create_orders(1)[0]
+        resp = self.client.patch(f"{BASE_URL}/{other.id}/items/{item_id}", json={"total": 5.0})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.patch(f"{BASE_URL}/{order_id}/items/{item_id}", json={"quantity": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.patch(f"{BASE_URL}/{order_id}/items/{item_id}", json={"order_id": other.id})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_add_item_nonexist_order(self):
         """It should Add an item to an non-existing order"""
         resp = self.client.post(f"{BASE_URL}/{NONEXIST_ORDER_ID}/items")
@@ -330,6 +1217,49 @@ class TestOrderServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_list_items_sparse_fields(self):
+        """ It should list only the requested fields of items """
+        order = self._create_orders(1)[0]
+        item = ItemFactory(order=order)
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item_id = resp.get_json()["id"]
+
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items", query_string="fields=id,quantity")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"id": item_id, "quantity": item.quantity}])
+
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items/{item_id}", query_string="fields=total")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"total": item.total})
+
+    def test_list_items_projected(self):
+        """ It should read only the requested items without loading their order """
+        order = self._create_orders(1)[0]
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory(order=order).serialize())
+        item_id = resp.get_json()["id"]
+        for cache in (LRUCache(maxsize=1000, ttl=60), NullCache()):
+            with patch.object(BaseModel, "cache", cache):
+                with self._count_queries() as statements:
+                    resp = self.client.get(f"{BASE_URL}/{order.id}/items", query_string="fields=id")
+                    self.assertEqual(resp.get_json(), [{"id": item_id}])
+                    resp = self.client.get(f"{BASE_URL}/{order.id}/items/{item_id}", query_string="fields=id")
+                    self.assertEqual(resp.get_json(), {"id": item_id})
+                with self._count_queries() as whole:
+                    self.client.get(f"{BASE_URL}/{order.id}/items/{item_id}")
+            self.assertFalse([statement for statement in statements if "address" in statement])
+            self.assertEqual(bool([statement for statement in whole if "address" in statement]),
+                             isinstance(cache, LRUCache))
+
+    def test_get_item_of_other_order(self):
+        """ It should not Read an Item through an Order it does not belong to """
+        orders = self._create_orders(2)
+        resp = self.client.post(f"{BASE_URL}/{orders[0].id}/items", json=ItemFactory(order=orders[0]).serialize())
+        item_id = resp.get_json()["id"]
+        for fields in ("", "fields=id"):
+            resp = self.client.get(f"{BASE_URL}/{orders[1].id}/items/{item_id}", query_string=fields)
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_list_items_nonexist_order(self):
         """It should list all items for an non-existing order"""
         resp = self.client.get(f"{BASE_URL}/{NONEXIST_ORDER_ID}/items")
@@ -532,6 +1462,38 @@ class TestOrderServer(TestCase):
         resp = self.client.get("/health")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_health_live(self):
+        """It should report the process is alive without the database"""
+        with patch("service.routes.check_database") as check_mock:
+            resp = self.client.get("/health/live")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        check_mock.assert_not_called()
+
+    def test_health_ready_cached(self):
+        """It should reuse the database check result within the TTL"""
+        database_check.clear()
+        with patch("service.routes.check_database", return_value=None) as check_mock:
+            for _ in range(3):
+                resp = self.client.get("/health/ready")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        check_mock.assert_called_once()
+        database_check.clear()
+
+    def test_health_database_down(self):
+        """It should report the service unavailable when the database is down"""
+        database_check.clear()
+        with patch("service.routes.check_database", return_value="connection refused"):
+            resp = self.client.get("/health/ready")
+        database_check.clear()
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_check_database(self):
+        """It should check the database over a pooled connection"""
+        self.assertIsNone(check_database(db.engine, 1))
+        engine = create_engine("postgresql://postgres@localhost:1/postgres")
+        self.assertIsNotNone(check_database(engine, 1))
+        engine.dispose()
+
     def test_method_not_allowed(self):
         """It should not allow an illegal method call"""
         resp = self.client.put(BASE_URL, json={"not": "today"})
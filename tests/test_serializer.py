@@ -0,0 +1,52 @@
+"""
+Test cases for Fast Serialization
+"""
+import json
+from datetime import date
+from unittest import TestCase
+from unittest.mock import patch
+from flask_restx import marshal
+from service.common import serializer
+from service.common.serializer import Serializer
+from service.routes import order_model, item_model
+from tests.factories import ItemFactory, OrderFactory
+
+
+class TestSerializer(TestCase):
+    """Test Cases for Fast Serialization"""
+
+    def setUp(self):
+        self.order = OrderFactory(date=date(2023, 7, 1))
+        self.order.items = [ItemFactory(order=self.order) for _ in range(2)]
+        self.orders = Serializer(order_model)
+
+    def test_matches_marshal(self):
+        """It should serialize a row exactly as marshal does"""
+        expected = marshal(self.order.serialize(), order_model)
+        data = self.orders.dump(self.order)
+        self.assertEqual(data, expected)
+        self.assertEqual(list(data), list(expected))
+        self.assertEqual(list(data["items"][0]), list(marshal(self.order.items[0], item_model)))
+        self.assertEqual(json.loads(self.orders.dumps([self.order])), [json.loads(json.dumps(expected))])
+
+    def test_matches_marshal_from_dict(self):
+        """It should serialize a cached dict exactly as marshal does"""
+        cached = self.order.serialize()
+        self.assertEqual(self.orders.dump(cached), marshal(cached, order_model))
+
+    def test_only_fields(self):
+        """It should serialize only the requested fields"""
+        only = ["id", "status"]
+        data = self.orders.dump(self.order, only)
+        self.assertEqual(data, marshal(self.order.serialize(), order_model, mask="id,status"))
+
+    def test_nulls(self):
+        """It should keep missing values as null"""
+        item = ItemFactory(order=self.order, quantity=None)
+        self.assertIsNone(Serializer(item_model).dump(item)["quantity"])
+
+    def test_stdlib_json(self):
+        """It should encode with the json module when orjson is not installed"""
+        with patch.object(serializer, "orjson", None):
+            body = self.orders.dumps(self.order)
+        self.assertEqual(json.loads(body), json.loads(json.dumps(marshal(self.order, order_model))))
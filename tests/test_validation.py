@@ -0,0 +1,47 @@
+"""
+Test cases for the Column Checks
+"""
+from datetime import date
+from unittest import TestCase
+from service.common.validation import check_values
+from service.models import Order, Item
+
+
+class TestValidation(TestCase):
+    """Test Cases for the Column Checks"""
+
+    def setUp(self):
+        self.orders = Order.__table__
+        self.items = Item.__table__
+
+    def test_valid_values(self):
+        """It should keep the values that fit their columns"""
+        values = {
+            "date": date(2023, 7, 1), "total": 10.5, "payment": "VEMO",
+            "address": "123 Main St", "customer_id": 42, "status": None,
+        }
+        self.assertEqual(check_values(self.orders, values), values)
+
+    def test_numbers_as_strings(self):
+        """It should convert the numbers sent as strings"""
+        values = check_values(self.items, {"product_id": "7", "quantity": 2.0, "total": "1.5"})
+        self.assertEqual(values, {"product_id": 7, "quantity": 2, "total": 1.5})
+
+    def test_bad_values(self):
+        """It should name the first value that does not fit its column"""
+        bad = [
+            (self.orders, {"payment": None}, "missing payment"),
+            (self.orders, {"payment": "CASH"}, "payment must be one of CREDITCARD, DEBITCARD, VEMO"),
+            (self.orders, {"address": "x" * 101}, "address must be at most 100 characters"),
+            (self.orders, {"address": 5}, "address must be a string"),
+            (self.orders, {"customer_id": 2**31}, "customer_id is out of range"),
+            (self.orders, {"date": "2023-07-01"}, "date must be a date"),
+            (self.items, {"quantity": 1.5}, "quantity must be an integer"),
+            (self.items, {"quantity": True}, "quantity must be an integer"),
+            (self.items, {"total": "lots"}, "total must be a number"),
+            (self.items, {"total": [1]}, "total must be a number"),
+        ]
+        for table, values, message in bad:
+            with self.assertRaises(ValueError) as context:
+                check_values(table, values)
+            self.assertEqual(str(context.exception), message)
@@ -0,0 +1,83 @@
+"""
+Test cases for the Worker Warm-up
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import OperationalError
+from service import app
+from service.common.cache import LRUCache, NullCache
+from service.common.warmup import WarmUp, warm_up
+from service.common.pagination import find_page
+from service.models import db, BaseModel, Order, CustomerSummary
+from tests.factories import ItemFactory, OrderFactory
+
+
+class TestWarmUp(TestCase):
+    """Test Cases for the Worker Warm-up"""
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        db.session.query(Order).delete()
+        db.session.query(CustomerSummary).delete()
+        db.session.commit()
+        orders = [OrderFactory() for _ in range(5)]
+        for order in orders:
+            order.items = [ItemFactory(order=order)]
+        Order.create_many(orders)
+        self.cache = LRUCache(maxsize=100, ttl=60)
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_warm_up(self):
+        """It should open the pool, run the finders and cache the newest orders"""
+        with patch.object(BaseModel, "cache", self.cache), patch.dict(app.config, WARMUP_ORDERS=3):
+            result = warm_up(app)
+        self.assertTrue(result["completed"])
+        self.assertEqual(result["connections"], app.config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"])
+        self.assertGreater(result["queries"], 1)
+        self.assertEqual(result["orders"], 3)
+        newest, _ = find_page(Order.base_query(), 3)
+        for order in newest:
+            self.assertEqual(len(self.cache.get(order.id)["items"]), 1)
+        self.assertEqual(self.cache.size(), 3)
+
+    def test_warm_up_without_cache(self):
+        """It should not preload the orders into the null cache"""
+        with patch.object(BaseModel, "cache", NullCache()), patch.object(WarmUp, "preload") as preload:
+            result = warm_up(app)
+        self.assertTrue(result["completed"])
+        self.assertGreater(result["queries"], 1)
+        self.assertEqual(result["orders"], 0)
+        preload.assert_not_called()
+
+    def test_preload_in_batches(self):
+        """It should cache every order when there are fewer than asked for"""
+        warmup = WarmUp(budget=10)
+        with patch.object(BaseModel, "cache", self.cache):
+            warmup.preload(count=50, batch_size=2)
+        self.assertEqual(warmup.counters["orders"], 5)
+
+    def test_budget_spent(self):
+        """It should skip the steps left once the budget is spent"""
+        warmup = WarmUp(budget=0)
+        result = warmup.run([("pool", lambda: warmup.open_pool(2))])
+        self.assertFalse(result["completed"])
+        self.assertEqual(result["skipped"], ["pool"])
+        self.assertEqual(result["connections"], 0)
+
+    def test_step_failed(self):
+        """It should go on with the next step when one fails"""
+        warmup = WarmUp(budget=10)
+
+        def broken():
+            raise OperationalError("SELECT 1", {}, Exception("down"))
+
+        result = warmup.run([("pool", broken), ("finders", lambda: warmup.run_finders(10))])
+        self.assertEqual(result["skipped"], ["pool"])
+        self.assertGreater(result["queries"], 0)